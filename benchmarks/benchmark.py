@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+benchmark of spritesheet generation on synthetic sprite corpora
+
+every phase (loading, packing, drawing, PNG saving, CSS writing) is run
+in a separate process so its time and peak memory can be measured alone,
+results are written as JSON so runs of different versions can be compared
+
+usage: benchmark.py [options]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import Queue
+import resource
+import multiprocessing
+from io import BytesIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PIL import Image, ImageDraw
+
+from spritesticker import (SpriteSheet, BoxLayout, RepeatXLayout, SheetImage,
+        CssWriter, SmallestWidthAlgorithm, SkylineAlgorithm, setImageFolder)
+
+_distributions = {
+    'icons': lambda rnd: (rnd.choice([16, 16, 24, 32, 32, 48]),) * 2,
+    'uniform': lambda rnd: (rnd.randint(8, 128), rnd.randint(8, 128)),
+    'mixed': lambda rnd: rnd.choice([
+        lambda: (rnd.choice([16, 24, 32]),) * 2,
+        lambda: (rnd.randint(60, 300), rnd.randint(20, 60)),
+        lambda: (rnd.randint(8, 200), rnd.randint(8, 200)),
+    ])(),
+}
+
+def generateCorpus(folder, count, distribution='icons', strips=0, backgrounds=0, seed=0):
+    '''
+    draws reproducible set of sprite images into folder
+    returns description of images - list of dicts with SheetImage arguments
+    '''
+    rnd = random.Random(seed)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    sizeOf = _distributions[distribution]
+    corpus = []
+    for i in xrange(count):
+        filename = 'icon-%05d.png' % i
+        _drawIcon(rnd, sizeOf(rnd)).save(os.path.join(folder, filename))
+        item = {'filename': filename, 'usedInCss': '.icon-%d' % i}
+        if i < backgrounds:
+            item['color'] = rnd.choice(['white', 'black', '#eeeeee'])
+        corpus.append(item)
+    for i in xrange(strips):
+        filename = 'strip-%03d.png' % i
+        size = rnd.choice([1, 2, 4, 5, 8, 10]), rnd.randint(10, 80)
+        _drawIcon(rnd, size).save(os.path.join(folder, filename))
+        corpus.append({'filename': filename, 'usedInCss': '.strip-%d' % i, 'repeat': 'repeat-x'})
+    return corpus
+
+def _drawIcon(rnd, size):
+    image = Image.new('RGBA', size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for shape in xrange(rnd.randint(1, 4)):
+        box = sorted([rnd.randint(0, size[0]), rnd.randint(0, size[0])])
+        box = [box[0], rnd.randint(0, size[1] // 2), box[1], rnd.randint(size[1] // 2, size[1])]
+        color = tuple(rnd.randint(0, 255) for c in 'rgb') + (rnd.choice([128, 255]),)
+        rnd.choice([draw.rectangle, draw.ellipse])(box, fill=color)
+    return image
+
+def _createImages(corpus):
+    return [SheetImage(**item) for item in corpus]
+
+def _createSheets(corpus, algorithm):
+    images = _createImages(corpus)
+    sheets = [SpriteSheet('bench-box', BoxLayout([im for im in images if im.repeat == 'no-repeat'], algorithm=algorithm))]
+    strips = [im for im in images if im.repeat == 'repeat-x']
+    if strips:
+        sheets.append(SpriteSheet('bench-strips', RepeatXLayout(strips)))
+    return sheets
+
+def _draw(sheets):
+    canvases = []
+    for sheet in sheets:
+        sheet._partition()
+        for part in sheet.parts or [sheet]:
+            canvas = Image.new(part.mode, part.layout.size, part.matteColor)
+            part._drawImagesInto(canvas)
+            canvases.append(canvas)
+    return canvases
+
+def _placed(corpus, algorithm):
+    sheets = _createSheets(corpus, algorithm)
+    for sheet in sheets:
+        sheet._partition()
+        for part in sheet.parts or [sheet]:
+            part._placeImages()
+    return sheets
+
+def _loadImages(images):
+    for im in images:
+        im.image.load()
+    return {}
+
+def _pack(rects, algorithm):
+    alg = algorithm(rects)
+    alg.compute()
+    return {'fillingCoef': alg.fillingCoef, 'size': list(alg.size)}
+
+def _drawSheets(sheets):
+    _draw(sheets)
+    return {}
+
+def _save(canvases):
+    outputBytes = 0
+    for canvas in canvases:
+        data = BytesIO()
+        canvas.save(data, 'PNG', optimize=True)
+        outputBytes += len(data.getvalue())
+    return {'outputBytes': outputBytes}
+
+def _writeCss(sheets, output):
+    #spritesheets are not written, so their content hashes are not known
+    writer = CssWriter(versioning=None)
+    for sheet in sheets:
+        writer.register(sheet)
+    writer.write(os.path.join(output, 'bench.css'))
+    return {}
+
+#every phase consists of unmeasured preparation and measured function
+_phases = [
+    ('load', lambda corpus, algorithm, output: (_loadImages, _createImages(corpus))),
+    ('pack', lambda corpus, algorithm, output: (_pack,
+        [im.getOuterRect() for im in _createImages(corpus) if im.repeat == 'no-repeat'], algorithm)),
+    ('draw', lambda corpus, algorithm, output: (_drawSheets, _placed(corpus, algorithm))),
+    ('save', lambda corpus, algorithm, output: (_save, _draw(_placed(corpus, algorithm)))),
+    ('css', lambda corpus, algorithm, output: (_writeCss, _placed(corpus, algorithm), output)),
+]
+
+def _measure(queue, prepare, corpus, algorithm, output):
+    setImageFolder(output)
+    phase = prepare(corpus, algorithm, output)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = phase[0](*phase[1:])
+    seconds = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result.update(seconds=seconds, peakMemoryKB=after, peakMemoryGrowthKB=after - before)
+    queue.put(result)
+
+def runPhase(name, prepare, corpus, algorithm, output):
+    'runs phase in a fresh process and returns its measurements'
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(queue, prepare, corpus, algorithm, output))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            #result of finished process is already in the queue
+            if not process.is_alive() and queue.empty():
+                raise RuntimeError('phase %s failed with exit code %s' % (name, process.exitcode))
+    process.join()
+    return result
+
+def main():
+    parser = OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option('-n', '--count', type='int', default=2000, help='number of icons')
+    parser.add_option('-d', '--distribution', default='icons', choices=sorted(_distributions), help='size distribution of icons')
+    parser.add_option('--strips', type='int', default=20, help='number of repeat-x strips')
+    parser.add_option('--backgrounds', type='int', default=100, help='number of icons with background color')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('-a', '--algorithm', default='SmallestWidthAlgorithm', choices=['SmallestWidthAlgorithm', 'SkylineAlgorithm'])
+    parser.add_option('-w', '--workdir', default='bench_corpus', help='folder for generated images')
+    parser.add_option('-o', '--output', default='bench_output.json', help='JSON file with results')
+    options, args = parser.parse_args()
+
+    algorithm = {'SmallestWidthAlgorithm': SmallestWidthAlgorithm, 'SkylineAlgorithm': SkylineAlgorithm}[options.algorithm]
+    corpus = generateCorpus(options.workdir, options.count, options.distribution,
+            options.strips, options.backgrounds, options.seed)
+    results = {
+        'corpus': {
+            'count': options.count,
+            'distribution': options.distribution,
+            'strips': options.strips,
+            'backgrounds': options.backgrounds,
+            'seed': options.seed,
+        },
+        'algorithm': options.algorithm,
+        'python': sys.version.split()[0],
+        'phases': {},
+    }
+    for name, phase in _phases:
+        results['phases'][name] = runPhase(name, phase, corpus, algorithm, options.workdir)
+        print '%-5s %8.3fs %8dKB' % (name, results['phases'][name]['seconds'], results['phases'][name]['peakMemoryKB'])
+    results['fillingCoef'] = results['phases']['pack']['fillingCoef']
+    results['outputBytes'] = results['phases']['save']['outputBytes']
+    print 'filling coeficient %.2f%%, output %d bytes' % (results['fillingCoef'] * 100.0, results['outputBytes'])
+    fout = open(options.output, 'w')
+    try:
+        json.dump(results, fout, sort_keys=True, indent=1, separators=(',', ': '))
+    finally:
+        fout.close()
+
+if __name__ == '__main__':
+    main()
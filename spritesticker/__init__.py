@@ -60,15 +60,31 @@ EXAMPLE:
 
 from spritesheet import (
         SpriteSheet,
-        setPngOptimizer)
+        setPngOptimizer,
+        setPrefetching,
+        addBuildHook,
+        removeBuildHook)
 from layouts import (
         SpriteLayout,
         RepeatXLayout,
-        BoxLayout)
+        RepeatYLayout,
+        BoxLayout,
+        PageLayout)
 from sheetimage import (
         SheetImage,
         CssProp,
-        setImageFolder)
+        setImageFolder,
+        setLazyLoading,
+        setImageCache,
+        setPixelCache)
 from writers import (
         CssWriter)
+from project import (
+        SpriteProject)
+from stats import (
+        BuildStats,
+        printStats)
+from packing import (
+        SmallestWidthAlgorithm,
+        SkylineAlgorithm)
         
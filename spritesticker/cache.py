@@ -0,0 +1,184 @@
+'''
+caching of decoded images between builds
+'''
+
+import os
+import json
+import mmap
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+import PIL.Image
+
+from utils import fileHash
+
+def decodeImage(path):
+    image = PIL.Image.open(path)
+    image.load()
+    return image
+
+def imageBytes(image):
+    'size of decoded pixels in memory'
+    width, height = image.size
+    return width * height * len(image.getbands())
+
+class ImageCache:
+    '''
+    bounded LRU cache of decoded images
+
+    images are kept by path and decoded again when modification
+    time or size of the file changes, cached images are shared
+    so they must not be modified
+    '''
+    def __init__(self, maxBytes, decode=decodeImage):
+        '''
+        maxBytes - maximal summary size of decoded pixels,
+                   the least recently used images are evicted
+        decode - function returning decoded image of file
+        '''
+        self.maxBytes = maxBytes
+        self.decode = decode
+        self.bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        'returns decoded image of file'
+        stat = os.stat(path)
+        version = stat.st_mtime, stat.st_size
+        with self.lock:
+            item = self.images.pop(path, None)
+            if item is not None:
+                self.bytes -= imageBytes(item[1])
+                if item[0] == version:
+                    self._add(path, item)
+                    return item[1]
+        image = self.decode(path)
+        with self.lock:
+            if path not in self.images:
+                self._add(path, (version, image))
+        return image
+
+    def _add(self, path, item):
+        size = imageBytes(item[1])
+        if size > self.maxBytes:
+            return
+        self.images[path] = item
+        self.bytes += size
+        while self.bytes > self.maxBytes:
+            path, (version, image) = self.images.popitem(last=False)
+            self.bytes -= imageBytes(image)
+
+class PixelCache:
+    '''
+    persistent cache of decoded pixels
+
+    each image is stored in a file named by hash of the image file content,
+    it contains JSON header with mode, size and palette followed by raw pixels,
+    the file is memory mapped when read so images in L, P and RGBA modes
+    share pixels with the mapped file without copying
+    '''
+    modes = ('L', 'LA', 'P', 'RGB', 'RGBA')
+    suffix = '.pixels'
+
+    def __init__(self, folder, maxBytes):
+        '''
+        folder - folder for cache files, it is created when it does not exist
+        maxBytes - maximal summary size of cache files,
+                   the least recently used files are deleted
+        '''
+        self.folder = folder
+        self.maxBytes = maxBytes
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        #folder is scanned again only when the size limit may be exceeded
+        self.bytes = sum(size for mtime, size, path in self._listFiles())
+
+    def load(self, path):
+        'returns decoded image of file'
+        cachePath = os.path.join(self.folder, fileHash(path) + self.suffix)
+        try:
+            image = self._read(cachePath)
+            #modification time marks recently used files
+            os.utime(cachePath, None)
+            return image
+        except (EnvironmentError, ValueError, struct.error):
+            #missing or broken cache file
+            pass
+        image = decodeImage(path)
+        if image.mode in self.modes:
+            self.bytes += self._write(cachePath, image)
+            if self.bytes > self.maxBytes:
+                self._evict()
+        return image
+
+    def _read(self, cachePath):
+        fin = open(cachePath, 'rb')
+        try:
+            data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fin.close()
+        headerSize, = struct.unpack('>I', data[:4])
+        header = json.loads(data[4:4 + headerSize])
+        mode = str(header['mode'])
+        image = PIL.Image.frombuffer(mode, tuple(header['size']), buffer(data, 4 + headerSize), 'raw', mode, 0, 1)
+        if header['palette']:
+            image.putpalette(header['palette'])
+        transparency = header['transparency']
+        if isinstance(transparency, list):
+            #P images have alpha of palette entries, other modes transparent color
+            transparency = str(bytearray(transparency)) if mode == 'P' else tuple(transparency)
+        if transparency is not None:
+            image.info['transparency'] = transparency
+        return image
+
+    def _write(self, cachePath, image):
+        transparency = image.info.get('transparency')
+        if isinstance(transparency, str):
+            transparency = list(bytearray(transparency))
+        header = json.dumps({
+            'mode': image.mode,
+            'size': image.size,
+            'palette': image.getpalette() if image.mode == 'P' else None,
+            'transparency': transparency,
+        })
+        #renaming of complete file is atomic for concurrent builds
+        fd, tempPath = tempfile.mkstemp(self.suffix + '.tmp', dir=self.folder)
+        fout = os.fdopen(fd, 'wb')
+        try:
+            fout.write(struct.pack('>I', len(header)))
+            fout.write(header)
+            fout.write(image.tobytes())
+        finally:
+            fout.close()
+        os.rename(tempPath, cachePath)
+        return os.path.getsize(cachePath)
+
+    def _evict(self):
+        'deletes the least recently used files over size limit'
+        files = sorted(self._listFiles())
+        self.bytes = sum(size for mtime, size, path in files)
+        #some space is freed so the following writes do not scan the folder again
+        for mtime, size, path in files:
+            if self.bytes <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.bytes -= size
+
+    def _listFiles(self):
+        'returns (mtime, size, path) of cache files'
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
@@ -5,15 +5,28 @@ auxilliary functions for drawing repeated images
 from PIL import Image, ImageColor
 from packing import Rect
 
-def draw(sheet, sheetImage, rect):
+def draw(sheet, sheetImage, rect, scale=1):
+    '''
+    draws image with its color and background into rect of sheet
+    scale - resolution of sheet, rect is placement in 1x spritesheet
+    '''
+    destRect = _scaleRect(rect, scale)
     if sheetImage.color:
-        pasteColor(sheet, sheetImage.color, rect)
+        pasteColor(sheet, sheetImage.color, destRect)
     if sheetImage.background:
-        draw(sheet, sheetImage.background, rect)
+        draw(sheet, sheetImage.background, rect, scale)
 
     repeatX, repeatY = sheetImage.getRepeats()
-    pos = sheetImage.getInnerPos(rect.topleft)
-    blitSurface(sheetImage.image, pos, sheet, rect, repeatX, repeatY)
+    x, y = sheetImage.getInnerPos(rect.topleft)
+    blitSurface(sheetImage.getScaledImage(scale), (x * scale, y * scale), sheet, destRect, repeatX, repeatY)
+
+def _scaleRect(rect, scale):
+    if scale == 1:
+        return rect
+    scaled = Rect()
+    scaled.topleft = rect.left * scale, rect.top * scale
+    scaled.size = rect.width * scale, rect.height * scale
+    return scaled
 
 def pasteColor(sheet, color, rect):
     r, g, b = ImageColor.getrgb(color)
@@ -71,24 +84,33 @@ def blitSurface(src, pos, dest, destRect, repeatX, repeatY):
     '''
 
     left, top = pos
-    xCount, yCount = 1, 1
-    srcWidth, srcHeight = src.size
-
-    if repeatX:
-        left = (pos[0] - destRect.left) % srcWidth + destRect.left
-        if left > destRect.left:
-            left -= srcWidth
-        xCount = destRect.width / srcWidth + 1
-
-    if repeatY:
-        top = (pos[1] - destRect.top) % srcHeight + destRect.right
-        if top > destRect.top:
-            top -= srcHeight
-        yCount = destRect.height / srcHeight + 1
-
-    for y in xrange(yCount):
-        for x in xrange(xCount):
-            _blitSurface(src, (left, top), dest, destRect)
-            left += srcWidth
-        top += srcHeight
-
+    if repeatX or repeatY:
+        width, height = src.size
+        if repeatX:
+            left = destRect.left - (destRect.left - pos[0]) % width
+            width = destRect.right - left
+        if repeatY:
+            top = destRect.top - (destRect.top - pos[1]) % height
+            height = destRect.bottom - top
+        src = _tile(src, (width, height))
+    _blitSurface(src, (left, top), dest, destRect)
+
+def _tile(src, size):
+    '''
+    returns image of given size covered by repeated src image
+    tiled area is doubled in each step so only few pastes are needed
+    '''
+    tiled = src
+    while tiled.size[0] < size[0]:
+        tiled = _double(tiled, (tiled.size[0] * 2, tiled.size[1]), (tiled.size[0], 0))
+    while tiled.size[1] < size[1]:
+        tiled = _double(tiled, (tiled.size[0], tiled.size[1] * 2), (0, tiled.size[1]))
+    if tiled.size != size:
+        tiled = tiled.crop((0, 0) + size)
+    return tiled
+
+def _double(src, size, pos):
+    #crop outside of the image keeps mode, palette and transparency info
+    doubled = src.crop((0, 0) + size)
+    doubled.paste(src, pos)
+    return doubled
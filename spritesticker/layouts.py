@@ -2,35 +2,124 @@
 implements various layouts which controls image positioning
 '''
 
+import os
 from copy import copy
 from itertools import groupby
 
 from utils import lcm
-from packing import SmallestWidthAlgorithm
+from rect import Rect
+from packing import SmallestWidthAlgorithm, IncrementalAlgorithm, searchWidth
+from planning import planRepeatGroups, planPageGroups
 
-__all__ = ['SpriteLayout', 'BoxLayout', 'RepeatXLayout']
+__all__ = ['SpriteLayout', 'BoxLayout', 'RepeatXLayout', 'RepeatYLayout', 'PageLayout']
 
 class SpriteLayout(object):
     '''
     base class
     '''
+    incremental = False
+
     def __init__(self, images):
         self.size = 0, 0
         self.images = []
+        self.uniqueImages = []
+        self.uniqueKeys = []
         self.fillCoef = 0
         self.extend(images)
 
     def _initStartupPlacement(self):
+        '''
+        creates rects for images, identical images share one rect
+        returns list of rects which have to be placed
+        '''
         imagePositions = []
-        for im in self.images:
-            rect = im.getOuterRect()
+        self.uniqueImages = []
+        self.uniqueKeys = []
+        index = {}
+        for im, key in zip(self.images, self._getImageKeys()):
+            rect = index.get(key)
+            if rect is None:
+                rect = im.getOuterRect()
+                index[key] = rect
+                self.uniqueImages.append(im)
+                #file key does not change when an image of the same size is added
+                self.uniqueKeys.append(repr(im.fileKey()))
+                imagePositions.append(rect)
             im.displayRect = rect
-            imagePositions.append(rect)
         return imagePositions
 
+    def _getImageKeys(self):
+        '''
+        returns keys of images, images with the same key look the same
+        images are compared by file hashes, pixels are decoded and compared
+        only for different files of the same size
+        '''
+        fileKeys = [im.fileKey() for im in self.images]
+        bySize = {}
+        for im, key in zip(self.images, fileKeys):
+            bySize.setdefault(im.size, {}).setdefault(key, im)
+        pixelKeys = {}
+        for images in bySize.values():
+            if len(images) > 1:
+                for key, im in images.items():
+                    pixelKeys[key] = im.contentKey()
+        return [pixelKeys.get(key, key) for key in fileKeys]
+
     def placeImages(self):
         raise NotImplementedError('this method is shold be overriden in the offsprings')
 
+    def getParameters(self):
+        'returns parameters which affect placement of images'
+        return {'layout': self.__class__.__name__}
+
+    def getPlacement(self):
+        '''
+        returns computed placement in form which can be stored
+        and restored by setPlacement
+        '''
+        unique = dict((id(im.displayRect), i) for i, im in enumerate(self.uniqueImages))
+        return {
+            'size': list(self.size),
+            'fillCoef': self.fillCoef,
+            'rects': [list(im.displayRect.box) for im in self.uniqueImages],
+            'index': [unique[id(im.displayRect)] for im in self.images],
+            'keys': self.uniqueKeys,
+        }
+
+    def setPlacement(self, placement):
+        'restores placement returned by getPlacement for the same images'
+        rects = []
+        for left, top, right, bottom in placement['rects']:
+            rect = Rect()
+            rect.topleft = left, top
+            rect.size = right - left, bottom - top
+            rects.append(rect)
+        self.uniqueImages = []
+        seen = set()
+        for im, i in zip(self.images, placement['index']):
+            if i not in seen:
+                seen.add(i)
+                self.uniqueImages.append(im)
+            im.displayRect = rects[i]
+        self.uniqueKeys = placement.get('keys', [])
+        self.size = tuple(placement['size'])
+        self.fillCoef = placement['fillCoef']
+
+    def seedPlacement(self, placement):
+        'placement of the previous build used by incremental layouts'
+        pass
+
+    def partition(self):
+        '''
+        returns list of layouts which should be written
+        into separate spritesheets
+        '''
+        return [self]
+
+    def createPart(self, images):
+        'returns layout of the same kind as partition creates for part of images'
+        raise NotImplementedError('this method is shold be overriden in the offsprings')
+
     def add(self, image):
         'add a image for appopriate CSS selector into container'
         if image.repeat != self.repeat:
@@ -46,6 +135,12 @@ class SpriteLayout(object):
         for im in self.images:
             yield im, im.displayRect
 
+    @property
+    def placedUniqueImages(self):
+        'placed images without duplicates, each rect is returned once'
+        for im in self.uniqueImages:
+            yield im, im.displayRect
+
     @property
     def imagesCount(self):
         return len(self.images)
@@ -56,28 +151,221 @@ class BoxLayout(SpriteLayout):
     '''
     repeat = 'no-repeat'
 
+    def __init__(self, images, algorithm=SmallestWidthAlgorithm, searchWidths=0, timeLimit=None, processes=None,
+                 incremental=False, maxWaste=0.5, maxSize=None, maxBytes=None):
+        '''
+        algorithm - PackingAlgorithm subclass used for arranging images
+                    e.g. SkylineAlgorithm for large sets of images
+        searchWidths - number of sheet widths tried in parallel to find
+                       the smallest area, 0 uses algorithm default width
+        timeLimit - time budget for the width search in seconds
+        processes - size of the process pool for the width search
+        incremental - keep positions of images from the previous build,
+                      new images are placed into free space or below
+        maxWaste - ratio of unused area when incremental placement
+                   is dropped and all images are packed again
+        maxSize - maximal (width, height) of spritesheet, images which do not fit
+                  are split into more spritesheets name-0.png, name-1.png, ...
+        maxBytes - maximal spritesheet filesize estimated from sizes of image files,
+                   images over the budget are split into more spritesheets
+        '''
+        self.algorithm = algorithm
+        self.searchWidths = searchWidths
+        self.timeLimit = timeLimit
+        self.processes = processes
+        self.incremental = incremental
+        self.maxWaste = maxWaste
+        self.maxSize = maxSize and tuple(maxSize)
+        self.maxBytes = maxBytes
+        self.previousPlacement = None
+        super(BoxLayout, self).__init__(images)
+
+    def seedPlacement(self, placement):
+        if self.incremental:
+            self.previousPlacement = placement
+
+    def getParameters(self):
+        params = super(BoxLayout, self).getParameters()
+        params.update(
+            algorithm = self.algorithm.__name__,
+            searchWidths = self.searchWidths,
+            timeLimit = self.timeLimit,
+            incremental = self.incremental,
+            maxWaste = self.maxWaste,
+            maxSize = self.maxSize and list(self.maxSize),
+            maxBytes = self.maxBytes,
+        )
+        return params
+
+    def partition(self):
+        '''
+        splits images into groups fitting into maxSize and maxBytes,
+        images are taken in order of adding, copies of one file stay together
+        '''
+        if not self.maxSize and not self.maxBytes:
+            return [self]
+        groups = []
+        index = {}
+        for im in self.images:
+            key = im.contentHash(), tuple(im.margin), im.trim
+            if key not in index:
+                index[key] = len(groups)
+                groups.append([])
+            groups[index[key]].append(im)
+        parts = []
+        while groups:
+            count = self._fittingCount(groups)
+            parts.append(groups[:count])
+            groups = groups[count:]
+        if len(parts) < 2:
+            return [self]
+        return [self.createPart([im for group in part for im in group]) for part in parts]
+
+    def createPart(self, images):
+        return BoxLayout(images, self.algorithm, self.searchWidths, self.timeLimit, self.processes,
+                         self.incremental, self.maxWaste, self.maxSize)
+
+    def _fittingCount(self, groups):
+        'returns number of leading groups which fit into one spritesheet'
+        if self._fits(groups):
+            return len(groups)
+        if not self._fits(groups[:1]):
+            raise ValueError('image %s is larger than %dx%dpx' % ((groups[0][0].filename,) + self.maxSize))
+        low, high = 1, len(groups)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._fits(groups[:middle]):
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def _fits(self, groups):
+        if self.maxBytes and len(groups) > 1:
+            if sum(_estimateBytes(group[0]) for group in groups) > self.maxBytes:
+                return False
+        if not self.maxSize:
+            return True
+        maxWidth, maxHeight = self.maxSize
+        rects = [group[0].getOuterRect() for group in groups]
+        if max(rect.width for rect in rects) > maxWidth:
+            return False
+        alg = self.algorithm(rects)
+        alg.compute(maxWidth)
+        return alg.size[1] <= maxHeight
+
     def placeImages(self):    
         rects = self._initStartupPlacement()        
-        alg = SmallestWidthAlgorithm(rects)
+        if self.previousPlacement and rects and self._placeIncrementally(rects):
+            return
+        width = 0
+        if self.searchWidths and rects:
+            width = searchWidth(self.algorithm, rects, self.searchWidths, self.timeLimit, self.processes)
+        alg = self.algorithm(rects)
+        alg.compute(width)
+        if self.maxSize and (alg.size[0] > self.maxSize[0] or alg.size[1] > self.maxSize[1]):
+            #the widest allowed sheet is the one checked by partition
+            alg = self.algorithm(rects)
+            alg.compute(self.maxSize[0])
+        self.size = alg.size
+        self.fillCoef = alg.fillingCoef
+
+    def _placeIncrementally(self, rects):
+        '''
+        places rects with respect to previous placement
+        returns False when too much space would be wasted
+
+        images keep their positions when an image of the same size is added
+
+        >>> import shutil, tempfile
+        >>> from PIL import Image
+        >>> from sheetimage import SheetImage
+        >>> folder = tempfile.mkdtemp()
+        >>> def icons(names):
+        ...     for i, name in enumerate(names):
+        ...         Image.new('RGB', (10 + i, 10), (ord(name[0]), 0, 0)).save(os.path.join(folder, name))
+        ...     return [SheetImage(filename=os.path.join(folder, name)) for name in names]
+        >>> names = ['a%d.png' % i for i in range(5)]
+        >>> layout = BoxLayout(icons(names), incremental=True)
+        >>> layout.placeImages()
+        >>> before = [rect.topleft for im, rect in layout.placedImages]
+        >>> placement = layout.getPlacement()
+        >>> layout = BoxLayout(icons(['b.png']) + icons(names), incremental=True)
+        >>> layout.seedPlacement(placement)
+        >>> layout.placeImages()
+        >>> [rect.topleft for im, rect in layout.placedImages][1:] == before
+        True
+        >>> shutil.rmtree(folder)
+        '''
+        previous = {}
+        placement = self.previousPlacement
+        for key, box in zip(placement.get('keys', []), placement['rects']):
+            previous[key] = box
+        positions = []
+        for key, rect in zip(self.uniqueKeys, rects):
+            box = previous.get(key)
+            if box and (box[2] - box[0], box[3] - box[1]) == rect.size:
+                positions.append((box[0], box[1]))
+            else:
+                positions.append(None)
+        alg = IncrementalAlgorithm(rects, positions, tuple(placement['size']), self.algorithm)
         alg.compute()
+        if 1.0 - alg.fillingCoef > self.maxWaste:
+            return False
+        if self.maxSize and (alg.size[0] > self.maxSize[0] or alg.size[1] > self.maxSize[1]):
+            return False
         self.size = alg.size
         self.fillCoef = alg.fillingCoef
+        return True
         
+def _estimateBytes(image):
+    'estimated contribution of image to spritesheet filesize'
+    if image.path:
+        return os.path.getsize(image.path)
+    width, height = image.size
+    return width * height * 4
+
 class RepeatXLayout(SpriteLayout):
     '''
     layout for images with repeat-x
     '''
     repeat = 'repeat-x'
 
+    def __init__(self, images, maxSize=5000, requestCost=50000):
+        '''
+        maxSize - maximal width of spritesheet, images whose widths have
+                  too big least common multiple are split into more
+                  spritesheets
+        requestCost - area in pixels which is worth saving one spritesheet
+        '''
+        self.maxSize = maxSize
+        self.requestCost = requestCost
+        super(RepeatXLayout, self).__init__(images)
+
     def add(self, image):
         if image.marginLeft != 0 or image.marginRight != 0:
             raise ValueError('x repeated images cannot have left or right margin')
         super(RepeatXLayout, self).add(image)
 
+    def getParameters(self):
+        params = super(RepeatXLayout, self).getParameters()
+        params.update(maxSize=self.maxSize, requestCost=self.requestCost)
+        return params
+
+    def partition(self):
+        rects = [im.getOuterRect() for im in self.images]
+        groups = planRepeatGroups([(rect.width, rect.height) for rect in rects], self.maxSize, self.requestCost)
+        if len(groups) < 2:
+            return [self]
+        return [self.createPart([self.images[i] for i in group]) for group in groups]
+
+    def createPart(self, images):
+        return self.__class__(images, self.maxSize, self.requestCost)
+
     def placeImages(self):
         rects = self._initStartupPlacement()
         width = reduce(lcm, [rect.width for rect in rects])
-        if width > 5000:
+        if width > self.maxSize:
             raise ValueError('generated image will have width %dpx, check inputs' % width)
         height = 0
         for rect in rects:
@@ -90,17 +378,43 @@ class RepeatYLayout(SpriteLayout):
     '''
     layout for images with repeat-y
     '''
-    repeat = 'repeat-x'
+    repeat = 'repeat-y'
+
+    def __init__(self, images, maxSize=5000, requestCost=50000):
+        '''
+        maxSize - maximal height of spritesheet, images whose heights have
+                  too big least common multiple are split into more
+                  spritesheets
+        requestCost - area in pixels which is worth saving one spritesheet
+        '''
+        self.maxSize = maxSize
+        self.requestCost = requestCost
+        super(RepeatYLayout, self).__init__(images)
 
     def add(self, image):
         if image.marginTop != 0 or image.marginBottom != 0:
-            raise ValueError('x repeated images cannot have top or bottom margin')
+            raise ValueError('y repeated images cannot have top or bottom margin')
         super(RepeatYLayout, self).add(image)
 
+    def getParameters(self):
+        params = super(RepeatYLayout, self).getParameters()
+        params.update(maxSize=self.maxSize, requestCost=self.requestCost)
+        return params
+
+    def partition(self):
+        rects = [im.getOuterRect() for im in self.images]
+        groups = planRepeatGroups([(rect.height, rect.width) for rect in rects], self.maxSize, self.requestCost)
+        if len(groups) < 2:
+            return [self]
+        return [self.createPart([self.images[i] for i in group]) for group in groups]
+
+    def createPart(self, images):
+        return self.__class__(images, self.maxSize, self.requestCost)
+
     def placeImages(self):
         rects = self._initStartupPlacement()
         height = reduce(lcm, [rect.height for rect in rects])
-        if height > 5000:
+        if height > self.maxSize:
             raise ValueError('generated image will have height %dpx, check inputs' % height)
         width = 0
         for rect in rects:
@@ -109,3 +423,57 @@ class RepeatYLayout(SpriteLayout):
             rect.height = height
         self.size = width, height
 
+class PageLayout(SpriteLayout):
+    '''
+    splits images into spritesheets by pages where they are used,
+    images of each spritesheet are arranged by layout created by layoutFactory
+    '''
+    def __init__(self, images, pages, traffic=None, requestCost=20000, layoutFactory=BoxLayout):
+        '''
+        pages - dict mapping page to list of CSS selectors used on it
+        traffic - dict mapping page to its weight e.g. number of views,
+                  pages without traffic have weight 1
+        requestCost - cost of one more spritesheet download expressed in bytes
+        layoutFactory - function creating layout from list of images
+                        e.g. functools.partial(BoxLayout, algorithm=SkylineAlgorithm),
+                        it has to be picklable for SpriteProject (no lambda)
+        '''
+        self.pages = dict((page, sorted(selectors)) for page, selectors in pages.items())
+        self.traffic = dict.fromkeys(self.pages, 1)
+        self.traffic.update(traffic or {})
+        self.requestCost = requestCost
+        self.layoutFactory = layoutFactory
+        super(PageLayout, self).__init__(images)
+
+    def add(self, image):
+        #images are checked by layouts of partitions
+        self.images.append(image)
+
+    def getParameters(self):
+        params = super(PageLayout, self).getParameters()
+        params.update(pages=self.pages, traffic=self.traffic, requestCost=self.requestCost)
+        return params
+
+    def partition(self):
+        selectorPages = {}
+        for page, selectors in self.pages.items():
+            for selector in selectors:
+                selectorPages.setdefault(selector, set()).add(page)
+        items = []
+        for im in self.images:
+            pages = set()
+            for prop in im.cssProp:
+                pages.update(selectorPages.get(prop.selector, ()))
+            items.append((_estimateBytes(im), pages))
+        groups = planPageGroups(items, self.traffic, self.requestCost) or [[]]
+        return [self.createPart([self.images[i] for i in group]) for group in groups]
+
+    def createPart(self, images):
+        return self.layoutFactory(images)
+
+    def placeImages(self):
+        raise NotImplementedError('images are placed by layouts of partitions')
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
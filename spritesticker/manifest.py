@@ -0,0 +1,46 @@
+'''
+build manifest stored next to generated spritesheet
+
+it records everything which affects the generated image
+so an unchanged spritesheet need not to be generated again
+'''
+
+import os
+import json
+
+def getManifestPath(imagePath):
+    return os.path.splitext(imagePath)[0] + '.manifest'
+
+def loadManifest(imagePath):
+    'returns stored manifest or None when it does not exist or is broken'
+    path = getManifestPath(imagePath)
+    if not os.path.exists(path):
+        return None
+    fin = open(path)
+    try:
+        try:
+            return json.load(fin)
+        except ValueError:
+            return None
+    finally:
+        fin.close()
+
+def saveManifest(imagePath, signature, placement):
+    fout = open(getManifestPath(imagePath), 'w')
+    try:
+        json.dump({'signature': signature, 'placement': placement}, fout, sort_keys=True, indent=1, separators=(',', ': '))
+    finally:
+        fout.close()
+
+def isUpToDate(imagePath, signature, otherPaths=()):
+    '''
+    returns stored placement when the image (and images in otherPaths)
+    exists and was generated with the same signature, None otherwise
+    '''
+    manifest = loadManifest(imagePath)
+    if manifest is None or not all(os.path.exists(path) for path in [imagePath] + list(otherPaths)):
+        return None
+    #normalize tuples and other types in the same way as stored data
+    if manifest.get('signature') != json.loads(json.dumps(signature)):
+        return None
+    return manifest.get('placement')
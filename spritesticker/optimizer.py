@@ -0,0 +1,146 @@
+'''
+running of external PNG optimizers on generated spritesheets
+'''
+
+import os
+import time
+import shlex
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+class OptimizerError(RuntimeError): pass
+
+class OptimizerResult:
+    '''
+    statistics of one optimizer run
+
+    attributes:
+        inputBytes - size of PNG data passed to optimizer
+        outputBytes - size of optimized PNG file
+        seconds - wall time of optimizer process
+    '''
+    def __init__(self, inputBytes, outputBytes, seconds):
+        self.inputBytes = inputBytes
+        self.outputBytes = outputBytes
+        self.seconds = seconds
+
+    @property
+    def bytesSaved(self):
+        return self.inputBytes - self.outputBytes
+
+class PngOptimizer:
+    '''
+    runs external optimizer with bounded number of concurrent processes,
+    the bound is shared by threads (resolution variants) and worker processes
+    of SpriteProject forked after the optimizer was created
+
+    command with two %s placeholders gets input and output filename
+    e.g. 'pngcrush %s %s', command without placeholders has to read PNG
+    data from stdin and write them to stdout e.g. 'pngquant -'
+    which avoids temporary files
+    '''
+    def __init__(self, cmd, processes=None, timeout=None):
+        '''
+        cmd - command template
+        processes - maximal number of concurrently running optimizers
+                    in all processes of the build, default is number of CPUs
+        timeout - optimizer process is killed after timeout seconds
+        '''
+        self.cmd = cmd
+        self.args = _stripRedirections(shlex.split(cmd))
+        self.pipe = '%s' not in cmd
+        self.processes = processes or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self._slots = multiprocessing.BoundedSemaphore(self.processes)
+
+    def optimize(self, data, path):
+        '''
+        optimizes PNG data and writes result into path
+        returns OptimizerResult, raises OptimizerError when optimizer fails
+        '''
+        with self._slots:
+            start = time.time()
+            if self.pipe:
+                output = self._run(self.args, data)
+                fout = open(path, 'wb')
+                try:
+                    fout.write(output)
+                finally:
+                    fout.close()
+            else:
+                self._runWithFiles(data, path)
+            seconds = time.time() - start
+        return OptimizerResult(len(data), os.path.getsize(path), seconds)
+
+    def _runWithFiles(self, data, path):
+        fd, tmpfile = tempfile.mkstemp(suffix='.png')
+        try:
+            fout = os.fdopen(fd, 'wb')
+            try:
+                fout.write(data)
+            finally:
+                fout.close()
+            placeholders = iter([tmpfile, path])
+            args = []
+            for arg in self.args:
+                while '%s' in arg:
+                    arg = arg.replace('%s', placeholders.next(), 1)
+                args.append(arg)
+            self._run(args, None)
+        finally:
+            os.remove(tmpfile)
+
+    def _run(self, args, data):
+        'runs optimizer process, returns its standard output'
+        try:
+            process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError, e:
+            raise OptimizerError('cannot run %s: %s' % (args[0], e))
+        killed = []
+        timer = None
+        if self.timeout:
+            def kill():
+                killed.append(True)
+                process.kill()
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+        try:
+            output, errors = process.communicate(data)
+        finally:
+            if timer:
+                timer.cancel()
+        if killed:
+            raise OptimizerError('%s was killed after %ss' % (args[0], self.timeout))
+        if process.returncode != 0:
+            raise OptimizerError('%s failed with exit code %d: %s' % (args[0], process.returncode, errors.strip()))
+        return output
+
+def _stripRedirections(args):
+    '''
+    removes shell output redirections which were needed when optimizer
+    was run by os.system, optimizer output is captured now
+
+    >>> _stripRedirections(['pngcrush', '%s', '%s', '>', '/dev/null'])
+    ['pngcrush', '%s', '%s']
+    >>> _stripRedirections(['pngcrush', '%s', '%s', '2>/dev/null'])
+    ['pngcrush', '%s', '%s']
+    '''
+    result = []
+    skipNext = False
+    for arg in args:
+        if skipNext:
+            skipNext = False
+        elif arg in ('>', '2>', '&>'):
+            skipNext = True
+        elif arg.startswith(('>', '2>', '&>')):
+            pass
+        else:
+            result.append(arg)
+    return result
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
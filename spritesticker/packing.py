@@ -2,6 +2,11 @@
 implements packing problem approximation how for a set of rectangles choose the rect which will best cover them.
 '''
 
+import time
+import multiprocessing
+from math import sqrt
+from itertools import imap
+
 from utils import transpose, findfirst   
 from rect import Rect
 
@@ -86,3 +91,266 @@ class SmallestWidthAlgorithm(PackingAlgorithm):
     def _sortRects(self):
         self.rects.sort(key=lambda item: item.height, reverse=True)
 
+
+class SkylineAlgorithm(PackingAlgorithm):
+    '''
+    bottom-left skyline approximation
+
+    the free space above the placed rects is kept as a skyline - list of
+    [x, y, width] segments ordered from left to right. Every rect is placed
+    onto the segment where its top edge ends lowest (ties are resolved
+    by smaller wasted area under the rect) so the cost of a placement
+    depends only on the number of segments and not on the number of rects.
+    '''
+    def __init__(self, rects):
+        PackingAlgorithm.__init__(self, rects)
+        self.skyline = []
+
+    def defaultWidth(self):
+        'width of a square which would be able to contain all rects'
+        return max(self.minWidth(), int(sqrt(self.minAreaBound())) + 1)
+
+    def compute(self, width=0):
+        if not self.rects:
+            return self.rects
+        if width == 0:
+            width = self.defaultWidth()
+        if width < self.minWidth():
+            raise AlgorithmError('algorithm cannot place any remaining rect to ensure predefined width')
+        self.skyline = [[0, 0, width]]
+        self._sortRects()
+        for rect in self.rects:
+            self._placeRect(rect, width)
+        self.shrinkSize()
+        self.size = width, self.size[1]
+        return self.rects
+
+    def _findPosition(self, rectWidth, rectHeight, width):
+        'returns index of starting segment, x and y of the best position'
+        skyline = self.skyline
+        best = None
+        bestTop = bestWaste = None
+        count = len(skyline)
+        for i in xrange(count):
+            x = skyline[i][0]
+            if x + rectWidth > width:
+                break
+            #find the highest segment under the rect
+            y = 0
+            j = i
+            remaining = rectWidth
+            while remaining > 0:
+                segX, segY, segWidth = skyline[j]
+                if segY > y:
+                    y = segY
+                    if bestTop is not None and y + rectHeight > bestTop:
+                        break
+                remaining -= segWidth
+                j += 1
+            if bestTop is not None and y + rectHeight > bestTop:
+                continue
+            waste = 0
+            remaining = rectWidth
+            for k in xrange(i, j):
+                segX, segY, segWidth = skyline[k]
+                covered = min(remaining, segWidth)
+                waste += (y - segY) * covered
+                remaining -= covered
+            if bestTop is None or y + rectHeight < bestTop or waste < bestWaste:
+                best = i, x, y
+                bestTop = y + rectHeight
+                bestWaste = waste
+        return best
+
+    def _placeRect(self, rect, width):
+        i, x, y = self._findPosition(rect.width, rect.height, width)
+        rect.topleft = x, y
+        skyline = self.skyline
+        right = x + rect.width
+        #remove or shorten the segments covered by the new one
+        j = i
+        while j < len(skyline) and skyline[j][0] < right:
+            segX, segY, segWidth = skyline[j]
+            if segX + segWidth <= right:
+                j += 1
+            else:
+                skyline[j] = [right, segY, segX + segWidth - right]
+                break
+        skyline[i:j] = [[x, rect.bottom, rect.width]]
+        self._mergeSegments(i)
+
+    def _mergeSegments(self, i):
+        'merge the segment i with its neighbours of the same height'
+        skyline = self.skyline
+        if i + 1 < len(skyline) and skyline[i + 1][1] == skyline[i][1]:
+            skyline[i][2] += skyline[i + 1][2]
+            del skyline[i + 1]
+        if i > 0 and skyline[i - 1][1] == skyline[i][1]:
+            skyline[i - 1][2] += skyline[i][2]
+            del skyline[i]
+
+    def _sortRects(self):
+        self.rects.sort(key=lambda item: (item.height, item.width), reverse=True)
+
+class IncrementalAlgorithm(PackingAlgorithm):
+    '''
+    keeps rects on positions from previous arrangement
+
+    free space of the previous arrangement is tracked as a list of maximal
+    free rectangles, new rects are put into the free rectangle where they
+    fit best (best short side fit). Rects which do not fit anywhere are
+    arranged by the fallback algorithm below the previous arrangement.
+    '''
+    def __init__(self, rects, positions, previousSize, algorithm=SkylineAlgorithm):
+        '''
+        positions - previous topleft position for each rect or None for new rects
+        previousSize - size of the previous arrangement
+        algorithm - PackingAlgorithm used for rects which do not fit
+        '''
+        PackingAlgorithm.__init__(self, rects)
+        self.positions = positions
+        self.previousSize = previousSize
+        self.algorithm = algorithm
+        self.freeRects = []
+
+    def compute(self, width=0):
+        if not self.rects:
+            return self.rects
+        width = max(width, self.previousSize[0], self.minWidth())
+        self.freeRects = [(0, 0, width, self.previousSize[1])]
+        newRects = []
+        for rect, pos in zip(self.rects, self.positions):
+            if pos is None:
+                newRects.append(rect)
+            else:
+                rect.topleft = pos
+                self._splitFreeRects(rect)
+        newRects.sort(key=lambda rect: rect.area, reverse=True)
+        remaining = []
+        for rect in newRects:
+            pos = self._findPosition(rect)
+            if pos is None:
+                remaining.append(rect)
+            else:
+                rect.topleft = pos
+                self._splitFreeRects(rect)
+        height = self.previousSize[1]
+        if remaining:
+            alg = self.algorithm(remaining)
+            alg.compute(width)
+            for rect in remaining:
+                rect.top += height
+        self.shrinkSize()
+        self.size = width, self.size[1]
+        return self.rects
+
+    def _findPosition(self, rect):
+        'returns topleft of the free rect where rect fits best'
+        best = None
+        bestFit = None
+        for left, top, width, height in self.freeRects:
+            if rect.width <= width and rect.height <= height:
+                fit = min(width - rect.width, height - rect.height), top, left
+                if bestFit is None or fit < bestFit:
+                    bestFit = fit
+                    best = left, top
+        return best
+
+    def _splitFreeRects(self, rect):
+        'removes the area of rect from free rectangles'
+        left, top, right, bottom = rect.box
+        kept = []
+        pieces = []
+        for free in self.freeRects:
+            fLeft, fTop, fWidth, fHeight = free
+            fRight, fBottom = fLeft + fWidth, fTop + fHeight
+            if left >= fRight or right <= fLeft or top >= fBottom or bottom <= fTop:
+                kept.append(free)
+                continue
+            if left > fLeft:
+                pieces.append((fLeft, fTop, left - fLeft, fHeight))
+            if right < fRight:
+                pieces.append((right, fTop, fRight - right, fHeight))
+            if top > fTop:
+                pieces.append((fLeft, fTop, fWidth, top - fTop))
+            if bottom < fBottom:
+                pieces.append((fLeft, bottom, fWidth, fBottom - bottom))
+        #new pieces are parts of removed rects so only they can be redundant
+        for i, piece in enumerate(pieces):
+            if not any(_contains(other, piece) for other in kept + pieces[i + 1:]):
+                kept.append(piece)
+        self.freeRects = kept
+
+def _contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and \
+           outer[0] + outer[2] >= inner[0] + inner[2] and outer[1] + outer[3] >= inner[1] + inner[3]
+
+def _computeArea(job):
+    'packs copies of rects with given width in a worker process'
+    algorithm, sizes, width = job
+    rects = []
+    for size in sizes:
+        rect = Rect()
+        rect.size = size
+        rects.append(rect)
+    alg = algorithm(rects)
+    alg.compute(width)
+    return width, alg.size
+
+def candidateWidths(rects, count):
+    '''
+    returns up to count widths spread from minimal width
+    to the double of the side of the smallest possible square
+    '''
+    alg = PackingAlgorithm(rects)
+    low = alg.minWidth()
+    high = max(low, 2 * int(sqrt(alg.minAreaBound())))
+    step = max(1, (high - low) // max(1, count - 1))
+    return range(low, high + 1, step)
+
+def searchWidth(algorithm, rects, count=32, timeLimit=None, processes=None):
+    '''
+    tries algorithm with various widths in a process pool
+    and returns the width resulting in the smallest area
+    (which is the same as the best filling coeficient)
+
+    count - number of tried widths
+    timeLimit - time budget in seconds, results which are not ready
+                in time are ignored
+    processes - size of the process pool, default is number of CPUs
+    '''
+    sizes = [rect.size for rect in rects]
+    jobs = [(algorithm, sizes, width) for width in candidateWidths(rects, count)]
+    deadline = timeLimit and time.time() + timeLimit
+    best = None
+    pool = None
+    if multiprocessing.current_process().daemon:
+        #workers of a pool e.g. in SpriteProject cannot start own processes
+        results = imap(_computeArea, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_computeArea, jobs)
+    try:
+        for i in xrange(len(jobs)):
+            if deadline:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    if pool:
+                        width, size = results.next(remaining)
+                    else:
+                        width, size = results.next()
+                except multiprocessing.TimeoutError:
+                    break
+            else:
+                width, size = results.next()
+            key = size[0] * size[1], abs(size[0] - size[1])
+            if best is None or key < best[0]:
+                best = key, width
+    finally:
+        if pool:
+            pool.terminate()
+    if best is None:
+        return 0
+    return best[1]
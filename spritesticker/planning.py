@@ -0,0 +1,99 @@
+'''
+planning how to split images into more spritesheets
+'''
+
+from utils import lcm
+
+def planRepeatGroups(items, maxPeriod, requestCost):
+    '''
+    groups repeated images so that each group fits into one spritesheet,
+    spritesheet size in the repeated direction is the least common multiple
+    of image periods so the groups are merged greedily while the saved
+    request outweighs the added area
+
+    items - list of (period, length) pairs, period is image size in the
+            repeated direction and length is the size in the other one
+    maxPeriod - maximal spritesheet size in the repeated direction
+    requestCost - cost of one more spritesheet expressed in pixels
+    returns list of groups, each group is a list of item indexes
+
+    >>> planRepeatGroups([(7, 10), (11, 10), (14, 10)], 5000, 100)
+    [[0, 2], [1]]
+    >>> planRepeatGroups([(7, 10), (11, 10), (14, 10)], 5000, 10000)
+    [[0, 1, 2]]
+    >>> planRepeatGroups([(7, 10), (11, 10), (14, 10)], 100, 10000)
+    [[0, 2], [1]]
+    '''
+    byPeriod = {}
+    for i, (period, length) in enumerate(items):
+        if period > maxPeriod:
+            raise ValueError('image has size %dpx in repeated direction, maximum is %dpx' % (period, maxPeriod))
+        group = byPeriod.setdefault(period, [period, 0, []])
+        group[1] += length
+        group[2].append(i)
+    groups = sorted(byPeriod.values(), key=lambda group: group[2][0])
+    while len(groups) > 1:
+        best = None
+        for i in xrange(len(groups)):
+            for j in xrange(i + 1, len(groups)):
+                (periodA, lengthA, _), (periodB, lengthB, _) = groups[i], groups[j]
+                period = lcm(periodA, periodB)
+                if period > maxPeriod:
+                    continue
+                saving = periodA * lengthA + periodB * lengthB + requestCost - period * (lengthA + lengthB)
+                if best is None or saving > best[0]:
+                    best = saving, i, j, period
+        if best is None or best[0] <= 0:
+            break
+        saving, i, j, period = best
+        groups[i] = [period, groups[i][1] + groups[j][1], sorted(groups[i][2] + groups[j][2])]
+        del groups[j]
+    return [group[2] for group in groups]
+
+def planPageGroups(items, traffic, requestCost):
+    '''
+    groups images so that pages download few spritesheets with few unused
+    images, images used by the same pages start in one group and groups
+    are merged greedily while the saved requests outweigh the bytes
+    downloaded in vain, both weighted by traffic of pages
+
+    items - list of (bytes, pages) pairs, pages is a set of pages using the image
+    traffic - dict mapping page to its weight e.g. number of views
+    requestCost - cost of one more spritesheet expressed in bytes
+    returns list of groups, each group is a list of item indexes
+
+    >>> items = [(1000, ['home', 'cart']), (1000, ['home']), (50000, ['cart'])]
+    >>> planPageGroups(items, {'home': 1, 'cart': 1}, 5000)
+    [[0, 1], [2]]
+    >>> planPageGroups(items, {'home': 1, 'cart': 1}, 100000)
+    [[0, 1, 2]]
+    >>> planPageGroups(items, {'home': 1, 'cart': 100}, 5000)
+    [[0, 2], [1]]
+    '''
+    byPages = {}
+    for i, (size, pages) in enumerate(items):
+        pages = frozenset(pages)
+        group = byPages.setdefault(pages, [0, pages, []])
+        group[0] += size
+        group[2].append(i)
+    groups = sorted(byPages.values(), key=lambda group: group[2][0])
+    weight = lambda pages: sum(traffic[page] for page in pages)
+    while len(groups) > 1:
+        best = None
+        for i in xrange(len(groups)):
+            for j in xrange(i + 1, len(groups)):
+                (sizeA, pagesA, _), (sizeB, pagesB, _) = groups[i], groups[j]
+                saving = (weight(pagesA & pagesB) * requestCost
+                          - weight(pagesA - pagesB) * sizeB - weight(pagesB - pagesA) * sizeA)
+                if best is None or saving > best[0]:
+                    best = saving, i, j
+        if best is None or best[0] <= 0:
+            break
+        saving, i, j = best
+        groups[i] = [groups[i][0] + groups[j][0], groups[i][1] | groups[j][1], sorted(groups[i][2] + groups[j][2])]
+        del groups[j]
+    return [group[2] for group in groups]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
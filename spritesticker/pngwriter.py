@@ -0,0 +1,141 @@
+'''
+incremental PNG encoder
+
+image rows are compressed as they come so the whole image
+never needs to be kept in memory
+'''
+
+import zlib
+import struct
+
+from PIL import Image, ImageChops, ImageMath
+
+_colorTypes = {
+    'L': (0, 1),
+    'RGB': (2, 3),
+    'LA': (4, 2),
+    'RGBA': (6, 4),
+}
+
+#filtered byte is interpreted as signed, its absolute value is the cost
+_costs = [min(value, 256 - value) for value in xrange(256)]
+
+def _paeth(left, up, upLeft):
+    'returns Paeth predictor of PNG filter type 4 computed on 32bit images'
+    a, b, c = [image.convert('I') for image in (left, up, upLeft)]
+    pa = ImageMath.eval('abs(b - c)', b=b, c=c)
+    pb = ImageMath.eval('abs(a - c)', a=a, c=c)
+    pc = ImageMath.eval('abs(a + b - c - c)', a=a, b=b, c=c)
+    useA = ImageMath.eval('(pa <= pb) & (pa <= pc)', pa=pa, pb=pb, pc=pc)
+    useB = ImageMath.eval('pb <= pc', pb=pb, pc=pc)
+    predictor = ImageMath.eval('a * useA + (1 - useA) * (b * useB + c * (1 - useB))',
+                               a=a, b=b, c=c, useA=useA, useB=useB)
+    return predictor.convert('L')
+
+def _chunk(kind, data):
+    crc = zlib.crc32(kind + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc)
+
+class PngWriter:
+    '''
+    writes PNG image into file object row by row
+
+    >>> from io import BytesIO
+    >>> out = BytesIO()
+    >>> writer = PngWriter(out, (2, 2), 'L')
+    >>> writer.writeRows('\\x00\\xff')
+    >>> writer.writeRows('\\xff\\x00')
+    >>> writer.close()
+    >>> out.getvalue()[:8]
+    '\\x89PNG\\r\\n\\x1a\\n'
+    >>> Image.open(out).tobytes()
+    '\\x00\\xff\\xff\\x00'
+    '''
+    chunkSize = 1 << 16
+
+    def __init__(self, fout, size, mode, level=9):
+        '''
+        fout - file object opened for binary writing
+        size - width and height of image
+        mode - PIL mode of written rows ('L', 'LA', 'RGB' or 'RGBA')
+        '''
+        if mode not in _colorTypes:
+            raise ValueError('mode %s is not supported by PngWriter' % mode)
+        self.fout = fout
+        self.width, self.height = size
+        colorType, self.channels = _colorTypes[mode]
+        self.stride = self.width * self.channels
+        self.rowsLeft = self.height
+        #row above the first row is treated as zeros by filters
+        self.previousRow = '\x00' * self.stride
+        self.compressor = zlib.compressobj(level)
+        self.pending = []
+        self.pendingSize = 0
+        self.fout.write('\x89PNG\r\n\x1a\n')
+        self.fout.write(_chunk('IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, colorType, 0, 0, 0)))
+
+    def writeRows(self, data):
+        'writes raw pixel data of whole rows e.g. PIL.Image.tobytes() output'
+        stride = self.stride
+        rows = len(data) // stride
+        if rows * stride != len(data):
+            raise ValueError('data does not contain whole rows')
+        if rows > self.rowsLeft:
+            raise ValueError('more rows than image height written')
+        self.rowsLeft -= rows
+        if rows:
+            self._addCompressed(self.compressor.compress(self._filter(data, rows)))
+            self.previousRow = data[-stride:]
+
+    def _filter(self, data, rows):
+        '''
+        returns rows prefixed by the filter type which gives the smallest
+        sum of absolute values of filtered bytes, rows are filtered
+        as 'L' images of bytes so all filters are computed by PIL
+        '''
+        stride = self.stride
+        size = stride, rows
+        raw = Image.frombytes('L', size, data)
+        up = Image.frombytes('L', size, self.previousRow + data[:-stride])
+        left = self._shifted(raw)
+        average = ImageChops.add(left, up, scale=2)
+        paeth = _paeth(left, up, self._shifted(up))
+        filtered = [raw] + [ImageChops.subtract_modulo(raw, other) for other in (left, up, average, paeth)]
+        costs = [image.point(_costs).convert('F').resize((1, rows), Image.BOX).getdata() for image in filtered]
+        filtered = [image.tobytes() for image in filtered]
+        result = []
+        for row in xrange(rows):
+            filterType = min(xrange(len(filtered)), key=lambda i: costs[i][row])
+            result.append(chr(filterType))
+            result.append(filtered[filterType][row * stride:(row + 1) * stride])
+        return ''.join(result)
+
+    def _shifted(self, image):
+        'returns bytes of preceding pixel in the same row'
+        shifted = Image.new('L', image.size)
+        shifted.paste(image.crop((0, 0, image.size[0] - self.channels, image.size[1])), (self.channels, 0))
+        return shifted
+
+    def close(self):
+        if self.rowsLeft:
+            raise ValueError('%d rows are missing' % self.rowsLeft)
+        self._addCompressed(self.compressor.flush())
+        self._flushChunk()
+        self.fout.write(_chunk('IEND', ''))
+
+    def _addCompressed(self, data):
+        if data:
+            self.pending.append(data)
+            self.pendingSize += len(data)
+        if self.pendingSize >= self.chunkSize:
+            self._flushChunk()
+
+    def _flushChunk(self):
+        if self.pending:
+            self.fout.write(_chunk('IDAT', ''.join(self.pending)))
+            self.pending = []
+            self.pendingSize = 0
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,63 @@
+'''
+decoding of images in a thread pool ahead of drawing
+'''
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+def _decode(image):
+    'decodes image and its backgrounds, opened files are read lazily by PIL'
+    while image:
+        image.image.load()
+        image = image.background
+
+def _decodedBytes(image):
+    size = 0
+    while image:
+        width, height = image.size
+        size += width * height * 4
+        image = image.background
+    return size
+
+def hashImages(images, threads):
+    'computes file hashes of images in a thread pool, hashlib releases GIL'
+    pool = ThreadPool(threads)
+    try:
+        pool.map(lambda image: image.fileKey(), images)
+    finally:
+        pool.close()
+        pool.join()
+
+def prefetchImages(placed, threads, maxBytes, stats=None):
+    '''
+    yields placed (image, rect) pairs in the same order while the following
+    images are decoded in a thread pool, decoding is postponed when decoded
+    images waiting for drawing would take more than maxBytes
+
+    time spent waiting for decoded images is added to 'load' phase of stats
+    '''
+    pool = ThreadPool(threads)
+    queue = deque()
+    queuedBytes = 0
+    try:
+        for item in placed:
+            size = _decodedBytes(item[0])
+            while queue and queuedBytes + size > maxBytes:
+                queuedBytes -= queue[0][2]
+                yield _wait(queue.popleft(), stats)
+            queue.append((item, pool.apply_async(_decode, (item[0],)), size))
+            queuedBytes += size
+        while queue:
+            yield _wait(queue.popleft(), stats)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _wait(queued, stats):
+    item, result, size = queued
+    if stats:
+        with stats.timer('load'):
+            result.get()
+    else:
+        result.get()
+    return item
@@ -0,0 +1,121 @@
+'''
+building of multiple spritesheets and their stylesheet at once
+'''
+
+import os
+import time
+import traceback
+import multiprocessing
+
+def _writeSheet(job):
+    'renders spritesheet in a worker process and returns its placement and stats'
+    sheet, path = job
+    stats = sheet.write(path)
+    return sheet.getPlacement(), stats
+
+def _sourceImages(sheet):
+    'returns images of spritesheet including backgrounds'
+    for im in sheet.layout.images:
+        while im:
+            yield im
+            im = im.background
+
+class SpriteProject:
+    '''
+    set of spritesheets sharing one CSS file
+
+    loading, packing, drawing and encoding of independent
+    spritesheets runs in a process pool, computed placements
+    are passed back and CSS file is written once
+    '''
+    def __init__(self, sheets, cssWriter, processes=None):
+        '''
+        sheets - list of SpriteSheet objects
+        cssWriter - CssWriter which receives all spritesheets
+        processes - size of the process pool, default is number of CPUs,
+                    1 writes spritesheets in current process
+        '''
+        self.sheets = list(sheets)
+        self.cssWriter = cssWriter
+        self.processes = processes
+
+    def write(self, cssFilename, path='', pathPrefix=''):
+        '''
+        writes all spritesheets into path and CSS file into cssFilename
+        pathPrefix - path prefix for spritesheets images in css file
+        returns list of BuildStats of spritesheets
+        '''
+        stats = self._writeSheets(path)
+        for sheet in self.sheets:
+            self.cssWriter.register(sheet)
+        self.cssWriter.write(cssFilename, pathPrefix)
+        return stats
+
+    def _writeSheets(self, path):
+        if self.processes == 1 or len(self.sheets) < 2:
+            return [sheet.write(path) for sheet in self.sheets]
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            results = pool.map(_writeSheet, [(sheet, path) for sheet in self.sheets], chunksize=1)
+        finally:
+            pool.terminate()
+        for sheet, (placement, stats) in zip(self.sheets, results):
+            sheet.setPlacement(placement)
+            sheet.setOutputPath(path)
+            sheet.stats = stats
+        return [stats for placement, stats in results]
+
+    def watch(self, cssFilename, path='', pathPrefix='', interval=1.0):
+        '''
+        writes the project and then rewrites spritesheets whenever
+        their image files change, runs until it is interrupted by Ctrl+C
+
+        changed spritesheets are written in current process, so decoded
+        images can be reused from the image cache (see setImageCache)
+        interval - seconds between checks of image files modification times
+        '''
+        self.write(cssFilename, path, pathPrefix)
+        mtimes = self._getModificationTimes()
+        try:
+            while True:
+                time.sleep(interval)
+                current = self._getModificationTimes()
+                changed = set(p for p in set(current) | set(mtimes) if current.get(p) != mtimes.get(p))
+                mtimes = current
+                if changed:
+                    try:
+                        self.rebuild(changed, cssFilename, path, pathPrefix)
+                    except Exception:
+                        #e.g. half written file, next change triggers rebuild again
+                        traceback.print_exc()
+        except KeyboardInterrupt:
+            pass
+
+    def rebuild(self, changedPaths, cssFilename, path='', pathPrefix=''):
+        '''
+        rewrites spritesheets which use any of changed files and CSS file
+        returns list of BuildStats of rewritten spritesheets
+        '''
+        changedPaths = set(changedPaths)
+        stats = []
+        for sheet in self.sheets:
+            images = [im for im in _sourceImages(sheet) if changedPaths.intersection(im.getSourcePaths(sheet.scales))]
+            if images:
+                for im in images:
+                    im.reload()
+                stats.append(sheet.write(path))
+        if stats:
+            for sheet in self.sheets:
+                self.cssWriter.register(sheet)
+            self.cssWriter.write(cssFilename, pathPrefix)
+        return stats
+
+    def _getModificationTimes(self):
+        'returns modification times of files which spritesheets can be read from'
+        mtimes = {}
+        for sheet in self.sheets:
+            for im in _sourceImages(sheet):
+                for path in im.getSourcePaths(sheet.scales):
+                    if path not in mtimes and os.path.exists(path):
+                        mtimes[path] = os.path.getmtime(path)
+        return mtimes
@@ -0,0 +1,154 @@
+'''
+in-process reduction of spritesheet colors
+'''
+
+import math
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageStat, features
+
+def quantize(image, colors=256, dither=True):
+    '''
+    returns palette ('P' mode) version of RGBA image, transparency is
+    stored in the palette so PNG encoder writes it as tRNS chunk
+
+    images with only fully opaque or fully transparent pixels are dithered
+    when dither is True, one palette entry is reserved for transparent
+    pixels, images with translucent pixels are never dithered
+
+    >>> import random
+    >>> random.seed(1)
+    >>> image = Image.new('RGBA', (64, 64))
+    >>> image.putdata([tuple(random.randint(0, 255) for i in range(3)) + (random.choice((0, 255)),)
+    ...                for i in range(64 * 64)])
+    >>> for colors, dither in [(8, False), (16, True), (256, False), (256, True)]:
+    ...     alpha = quantize(image, colors, dither).convert('RGBA').split()[3]
+    ...     print ImageChops.difference(alpha, image.split()[3]).getbbox()
+    None
+    None
+    None
+    None
+    '''
+    alpha = image.split()[3]
+    histogram = alpha.histogram()
+    if sum(histogram[1:255]) == 0:
+        return _quantizeBinaryAlpha(image, alpha, histogram[0] > 0, colors, dither)
+    if features.check('libimagequant'):
+        method = Image.LIBIMAGEQUANT
+    else:
+        method = Image.FASTOCTREE
+    return image.quantize(colors, method=method)
+
+def _quantizeBinaryAlpha(image, alpha, hasTransparent, colors, dither):
+    rgb = image.convert('RGB')
+    if hasTransparent:
+        colors -= 1
+    palette = rgb.quantize(colors)
+    #palette is padded by black entries, they get a used color so no pixel
+    #is mapped to them and then replaced by the used index
+    used = sorted(index for count, index in palette.getcolors(256))
+    entries = palette.getpalette()
+    fill = entries[used[0] * 3:used[0] * 3 + 3]
+    lut = range(256)
+    for index in set(range(256)) - set(used):
+        entries[index * 3:index * 3 + 3] = fill
+        lut[index] = used[0]
+    palette.putpalette(entries)
+    result = rgb.quantize(palette=palette, dither=dither and Image.FLOYDSTEINBERG or Image.NONE)
+    result = result.point(lut)
+    if hasTransparent:
+        transparent = colors
+        result.paste(transparent, mask=ImageChops.invert(alpha))
+        result.info['transparency'] = transparent
+    return result
+
+def reduceLossless(image):
+    '''
+    returns pixel identical version of RGBA image in the mode which
+    is encoded into the smallest PNG file, candidates are RGB for opaque
+    images, L or LA for gray images and palette with transparency
+    for images with at most 256 colors
+
+    palette entries can share RGB with different alpha, e.g. opaque white
+    and transparent white matte
+
+    >>> image = Image.new('RGBA', (32, 32), (255, 255, 255, 0))
+    >>> image.paste((255, 255, 255, 255), (8, 8, 24, 24))
+    >>> image.paste((255, 0, 0, 128), (12, 12, 20, 20))
+    >>> reduced = reduceLossless(image)
+    >>> reduced.mode
+    'P'
+    >>> reduced.convert('RGBA').tobytes() == image.tobytes()
+    True
+    '''
+    alpha = image.split()[3]
+    opaque = alpha.getextrema() == (255, 255)
+    if opaque:
+        base = image.convert('RGB')
+    else:
+        base = image
+    candidates = [base]
+    red, green, blue = image.split()[:3]
+    if ImageChops.difference(red, green).getbbox() is None and \
+       ImageChops.difference(green, blue).getbbox() is None:
+        if opaque:
+            candidates.append(red)
+        else:
+            candidates.append(Image.merge('LA', (red, alpha)))
+    colors = base.getcolors(256)
+    if colors:
+        candidates.append(_exactPalette(base, [color for count, color in colors]))
+    if len(candidates) == 1:
+        return base
+    return min(candidates, key=_encodedSize)
+
+def _exactPalette(image, colors):
+    '''
+    returns palette image with exactly the given colors,
+    entries can share RGB values and differ in alpha
+    '''
+    rgbs = [color[:3] for color in colors]
+    entries = [value for color in rgbs for value in color]
+    result = None
+    if len(set(rgbs)) == len(rgbs):
+        rgb = image.convert('RGB')
+        palette = Image.new('P', (1, 1))
+        palette.putpalette(entries)
+        result = rgb.quantize(palette=palette, dither=Image.NONE)
+        if ImageChops.difference(result.convert('RGB'), rgb).getbbox() is not None:
+            #nearest color search of PIL is not exact for very similar colors
+            result = None
+    if result is None:
+        index = dict((color, i) for i, color in enumerate(colors))
+        result = Image.new('P', image.size)
+        result.putpalette(entries)
+        result.putdata([index[pixel] for pixel in image.getdata()])
+    if image.mode == 'RGBA':
+        result.info['transparency'] = ''.join(chr(color[3]) for color in colors)
+    return result
+
+def _encodedSize(image):
+    data = BytesIO()
+    image.save(data, 'PNG', optimize=True)
+    return len(data.getvalue())
+
+def psnr(original, converted):
+    '''
+    peak signal to noise ratio in dB of converted image
+    compared to RGBA original, identical images have infinite PSNR
+    colors of pixels are weighted by their alpha
+    '''
+    difference = ImageChops.difference(_premultiplied(original), _premultiplied(converted.convert('RGBA')))
+    rms = ImageStat.Stat(difference).rms
+    mse = sum(value * value for value in rms) / len(rms)
+    if mse == 0:
+        return float('inf')
+    return 20 * math.log10(255 / math.sqrt(mse))
+
+def _premultiplied(image):
+    black = Image.new('RGBA', image.size, (0, 0, 0, 0))
+    return Image.composite(image, black, image.split()[3])
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
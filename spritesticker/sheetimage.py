@@ -1,9 +1,16 @@
 import os
+import struct
+import hashlib
 import PIL
 
 from rect import Rect
+from utils import fileHash
+from cache import ImageCache, PixelCache, decodeImage
 
 _imageFolder = ''
+_lazyLoading = False
+_imageCache = None
+_pixelCache = None
 
 def setImageFolder(path):
     '''
@@ -13,6 +20,69 @@ def setImageFolder(path):
     global _imageFolder
     _imageFolder = path
 
+def setLazyLoading(enabled):
+    '''
+    toggle lazy loading of image files
+
+    in lazy mode only image size is read when SheetImage is created,
+    pixels are decoded just before drawing and released after it
+    '''
+    global _lazyLoading
+    _lazyLoading = enabled
+
+def setImageCache(maxBytes):
+    '''
+    keep decoded images in memory cache of given size in bytes,
+    images released by lazy loading are not decoded again while cached
+
+    useful with SpriteProject.watch where files are read repeatedly
+    setImageCache(None) disables the cache
+    '''
+    global _imageCache
+    _imageCache = maxBytes and ImageCache(maxBytes, _decodeImage)
+
+def setPixelCache(folder, maxBytes=2**30):
+    '''
+    store decoded pixels of images in folder, files are memory mapped
+    when the same image is read again e.g. in another build
+    maxBytes - size limit of the folder, the least recently used files are deleted
+    setPixelCache(None) disables the cache
+    '''
+    global _pixelCache
+    _pixelCache = folder and PixelCache(folder, maxBytes)
+
+def openImage(path):
+    'returns image of file, decoded image is taken from caches when enabled'
+    if _imageCache:
+        return _imageCache.load(path)
+    if _pixelCache:
+        return _pixelCache.load(path)
+    return PIL.Image.open(path)
+
+def _decodeImage(path):
+    if _pixelCache:
+        return _pixelCache.load(path)
+    return decodeImage(path)
+
+_pngSignature = '\x89PNG\r\n\x1a\n'
+
+def readImageSize(path):
+    '''
+    returns size of image in file
+    reads only the header chunk of PNG files, other formats are opened by PIL
+    '''
+    fin = open(path, 'rb')
+    try:
+        header = fin.read(24)
+    finally:
+        fin.close()
+    if header[:8] == _pngSignature and header[12:16] == 'IHDR':
+        return struct.unpack('>II', header[16:24])
+    image = PIL.Image.open(path)
+    size = image.size
+    image.close()
+    return size
+
 class CssProp:
     def __init__(self, selector, pos=(0,0)):
         self.selector = selector
@@ -25,7 +95,7 @@ class SheetImage:
 
     attributes:
         path - full path to image file
-        _image - PIL.Image.Image object
+        _image - PIL.Image.Image object, None if it is not loaded
         see SheetImage.__init__
         ...
     '''
@@ -36,7 +106,8 @@ class SheetImage:
             'repeat': (True, True),
     }
 
-    def __init__(self, filename=None, image=None, margin=(0,0,0,0), pos=(0,0), color=None, background=None, usedInCss=None, repeat='no-repeat'):
+    def __init__(self, filename=None, image=None, margin=(0,0,0,0), pos=(0,0), color=None, background=None, usedInCss=None, repeat='no-repeat',
+                 trim=False):
         '''
         image can be filename or PIL.Image object
         pos - shifting image in pixels from topleft corner of image (not including margin).
@@ -48,21 +119,40 @@ class SheetImage:
                  it is used for reserving free space around image in sprite sheet.
                  Image size + margin + abs(image position) should be greater than containing div size.
         color, repeat - counterpart of same CSS property
+        trim - place only the part of image inside the bounding box of non transparent
+               pixels, CSS position is shifted so the image is displayed at the same place.
+               Margin is reserved around the trimmed part only. The trimmed-off area is
+               not reserved, so an element as large as the original image can show
+               neighbouring images there instead of transparency. Trim only images whose
+               elements do not show the transparent border. Only no-repeat images without
+               background can be trimmed.
         '''
         if filename and image:
             raise ArgumentError('only filename or image argument can be provided')
         if not filename and not image:
             raise ArgumentError('filename or image argument has to be provided')
-            
+        if trim and (repeat != 'no-repeat' or background):
+            raise ValueError('only no-repeat images without background can be trimmed')
+
+        self.trim = trim
+        self._trimBox = None
         if image:
             assert isinstance(image, PIL.Image.Image), 'other image types are not supported'
             self.filename = ''
             self.path = ''
-            self.image = image
+            self._size = image.size
+            self._image = self._trimmed(image)
+            self.lazy = False
         elif filename:
             self.filename = filename
             self.path = os.path.join(_imageFolder, self.filename)
-            self.image = PIL.Image.open(self.path)            
+            self.lazy = _lazyLoading
+            if self.lazy:
+                self._image = None
+                self._size = readImageSize(self.path)
+            else:
+                self._image = self._trimmed(openImage(self.path))
+                self._size = self._image.size
 
         self._setCssProp(usedInCss)
         self.margin = margin
@@ -70,6 +160,123 @@ class SheetImage:
         self.color = color
         self.background = background
         self.repeat = repeat
+        self._pixelHash = None
+        self._contentHash = None
+
+    @property
+    def image(self):
+        'PIL.Image.Image object, it is loaded when needed in lazy mode'
+        image = self._image
+        if image is None:
+            #local reference stays valid when other thread releases the image
+            image = openImage(self.path)
+            image.load()
+            image = self._image = self._trimmed(image)
+        return image
+
+    @property
+    def size(self):
+        if self.trim and self._trimBox is None:
+            #trimmed size is known after pixels are decoded
+            self.image
+            self.release()
+        return self._size
+
+    @property
+    def trimOffset(self):
+        'position of trimmed part in the original image'
+        if not self.trim:
+            return 0, 0
+        self.size
+        return self._trimBox[:2]
+
+    def _trimmed(self, image):
+        'returns image cropped to bounding box of non transparent pixels when trimming'
+        if not self.trim:
+            return image
+        if self._trimBox is None:
+            alpha = None
+            if image.mode in ('RGBA', 'LA'):
+                alpha = image.split()[-1]
+            elif 'transparency' in image.info:
+                alpha = image.convert('RGBA').split()[-1]
+            self._trimBox = (alpha and alpha.getbbox()) or (0, 0) + image.size
+        box = self._trimBox
+        self._size = box[2] - box[0], box[3] - box[1]
+        if box != (0, 0) + image.size:
+            image = image.crop(box)
+        return image
+
+    def reload(self):
+        'forget decoded pixels, size and hashes after image file was changed'
+        if not self.path:
+            return
+        self._trimBox = None
+        self._pixelHash = None
+        self._contentHash = None
+        if self.lazy:
+            self._image = None
+            self._size = readImageSize(self.path)
+        else:
+            self._image = self._trimmed(openImage(self.path))
+            self._size = self._image.size
+
+    def getSourcePaths(self, scales=(1,)):
+        'returns paths of files image can be read from including high resolution sources'
+        if not self.path:
+            return []
+        return [self.path] + [self._getScaledName(scale) for scale in scales if scale != 1]
+
+    def _getScaledName(self, scale):
+        root, ext = os.path.splitext(self.path)
+        return '%s@%dx%s' % (root, scale, ext)
+
+    def getScaledPath(self, scale):
+        'returns path of high resolution source e.g. icon@2x.png, None when it does not exist'
+        if not self.path:
+            return None
+        path = self._getScaledName(scale)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def getScaledImage(self, scale):
+        '''
+        returns image for spritesheet of given scale factor,
+        it is read from high resolution source or resampled
+        '''
+        if scale == 1:
+            return self.image
+        path = self.getScaledPath(scale)
+        if path is None:
+            image = self.image
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            width, height = image.size
+            return image.resize((width * scale, height * scale), PIL.Image.LANCZOS)
+        image = openImage(path)
+        width, height = readImageSize(self.path)
+        if image.size != (width * scale, height * scale):
+            raise ValueError('%s has to be %dx larger than %s' % (path, scale, self.path))
+        if self.trim:
+            self.size
+            image = image.crop(tuple(value * scale for value in self._trimBox))
+        image.load()
+        return image
+
+    def __getstate__(self):
+        'pixels of file images are not pickled, other process decodes the file itself'
+        state = self.__dict__.copy()
+        if self.path:
+            state['_image'] = None
+        return state
+
+    def release(self):
+        'forget decoded pixels of lazy loaded image and its background'
+        if self.lazy:
+            self._image = None
+        if self.background:
+            self.background.release()
 
     def _setCssProp(self, usedIn):
         if usedIn is None:
@@ -94,11 +301,66 @@ class SheetImage:
     def getOuterRect(self):
         r = Rect()
         r.size = (
-            self.marginLeft + self.image.size[0] + self.marginRight,
-            self.marginTop + self.image.size[1] + self.marginBottom
+            self.marginLeft + self.size[0] + self.marginRight,
+            self.marginTop + self.size[1] + self.marginBottom
         )
         return r
 
+    def pixelHash(self):
+        'digest of decoded pixels, images with same digest look the same'
+        if self._pixelHash is None:
+            digest = hashlib.md5()
+            digest.update('%s %dx%d' % ((self.image.mode,) + self.image.size))
+            if self.image.mode == 'P':
+                digest.update(str(self.image.getpalette()))
+                digest.update(str(self.image.info.get('transparency')))
+            digest.update(self.image.tobytes())
+            self._pixelHash = digest.hexdigest()
+            self.release()
+        return self._pixelHash
+
+    def contentHash(self):
+        'digest of image file or of pixels for images without file'
+        if not self.path:
+            return self.pixelHash()
+        if self._contentHash is None:
+            self._contentHash = fileHash(self.path)
+        return self._contentHash
+
+    def getSignature(self):
+        'returns all properties affecting image drawing in the spritesheet'
+        return {
+            'path': self.path,
+            'hash': self.contentHash(),
+            'margin': list(self.margin),
+            'repeat': self.repeat,
+            'trim': self.trim,
+            'color': self.color,
+            'background': self.background and self.background.getSignature(),
+        }
+
+    def getScaledSignature(self, scale):
+        'returns hashes of high resolution sources of image and its background'
+        path = self.getScaledPath(scale)
+        background = self.background and self.background.getScaledSignature(scale)
+        return [path and fileHash(path), background]
+
+    def fileKey(self):
+        '''
+        images with the same key are drawn identically into the spritesheet,
+        unlike contentKey it does not need pixels of images loaded from files
+        '''
+        background = self.background and self.background.fileKey()
+        return self.contentHash(), tuple(self.margin), self.repeat, self.color, self.trim, background
+
+    def contentKey(self):
+        '''
+        images with the same key are drawn identically into the spritesheet
+        so they can share one place
+        '''
+        background = self.background and self.background.contentKey()
+        return self.pixelHash(), tuple(self.margin), self.repeat, self.color, self.trim, background
+
     def getRepeats(self):
         return self._repeatDict[self.repeat]
 
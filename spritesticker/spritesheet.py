@@ -3,39 +3,120 @@ base module
 '''
 
 import os
-import tempfile
+from io import BytesIO
 from copy import copy
+from multiprocessing.pool import ThreadPool
 
 import PIL
 from PIL import ImageColor
 
 import sheetimage
-from utils import prettySize
 from draw import draw
+from manifest import isUpToDate, loadManifest, saveManifest
+from optimizer import PngOptimizer
+from pngwriter import PngWriter
+from rect import Rect
+from stats import BuildStats, printStats
+from utils import fileHash
+from quantize import quantize, psnr, reduceLossless
+from prefetch import hashImages, prefetchImages
 
-_pngOptimizer = ''
+_pngOptimizer = None
+_mimeTypes = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+_buildHooks = [printStats]
+_prefetchThreads = 0
+_prefetchBytes = 0
 
-def setPngOptimizer(cmd):
+def setPngOptimizer(cmd, processes=None, timeout=None):
     '''
     set a png optimizer command
     which is called on generated spritesheets
 
     e.g. pngcrush, pngnq, pngquant can be used
     setPngOptimizer('pngcrush %s %s')
+    command without %s placeholders gets data through stdin and stdout
+    setPngOptimizer('pngquant -')
+
+    processes - maximal number of concurrently running optimizers in all
+                worker processes of SpriteProject and resolution variants
+    timeout - optimizer is killed after timeout seconds
     '''
     global _pngOptimizer
-    _pngOptimizer = cmd
+    _pngOptimizer = cmd and PngOptimizer(cmd, processes, timeout)
+
+def setPrefetching(threads, maxBytes=2**28):
+    '''
+    decode images in a pool of threads, images are hashed in parallel
+    and lazy loaded images are decoded ahead of drawing
+
+    maxBytes - limit of decoded images waiting for drawing
+    setPrefetching(0) disables the thread pool
+    '''
+    global _prefetchThreads, _prefetchBytes
+    _prefetchThreads = threads
+    _prefetchBytes = maxBytes
+
+def addBuildHook(hook):
+    '''
+    register function called after every spritesheet is written
+    hook gets SpriteSheet and its BuildStats as arguments
+
+    human readable stats are printed by default hook printStats
+    which can be removed by removeBuildHook(printStats)
+    '''
+    _buildHooks.append(hook)
+
+def removeBuildHook(hook):
+    _buildHooks.remove(hook)
 
 class SpriteSheet:
-    def __init__(self, name, layout, matteColor=None, drawBackgrounds=True, mode='RGBA'):
+    def __init__(self, name, layout, matteColor=None, drawBackgrounds=True, mode='RGBA', useManifest=False,
+                 bandHeight=None, colors=256, dither=True, minQuality=None, formats=('png',), webpLossless=True,
+                 webpQuality=100, scales=(1,)):
         '''
         name - filename without suffix
         matteColor - bakckground color for generated stylesheet
         drawBackgrounds - toggle background images drawing
-        mode - is a PIL.Image.mode for generated image ('RGB' or 'RGBA')
+        mode - is a PIL.Image.mode for generated image ('RGB', 'RGBA' or 'P'),
+               'P' reduces colors of RGBA spritesheet to a palette with transparency,
+               'auto' chooses the smallest mode which keeps all pixels unchanged
+        useManifest - store build manifest next to generated image
+                      and skip generating when nothing has changed
+                      (manifest is always stored for incremental layouts
+                      which read previous placement from it)
+        bandHeight - draw and encode spritesheet by horizontal bands
+                     of given height, only one band is kept in memory
+        colors - maximal number of palette colors in 'P' mode
+        dither - toggle dithering in 'P' mode
+        minQuality - minimal PSNR in dB of palette image, when the palette image
+                     is worse, spritesheet is written in RGBA mode
+        formats - image formats written from the same spritesheet, 'png' has to be
+                  included as fallback e.g. ('png', 'webp')
+        webpLossless - toggle lossless WebP compression
+        webpQuality - WebP quality, for lossless compression it is compression effort
+        scales - integer resolution factors e.g. (1, 2) for HiDPI displays,
+                 variants use placement of 1x spritesheet and are named name@2x.png,
+                 images are read from high resolution sources (icon@2x.png)
+                 or resampled when the source does not exist
         '''
         assert layout, 'must be defined'
         assert name, 'non empty string is needed'
+        if bandHeight and mode not in ('RGB', 'RGBA'):
+            raise ValueError('banded drawing supports only RGB and RGBA mode')
+        if 'png' not in formats:
+            raise ValueError('png format is needed as fallback')
+        for format in formats:
+            if format not in _mimeTypes:
+                raise ValueError('unsupported format %s, use %s' % (format, ', '.join(sorted(_mimeTypes))))
+        if bandHeight and len(formats) > 1:
+            raise ValueError('banded drawing supports only png format')
+        if 1 not in scales:
+            raise ValueError('1x scale is needed as fallback')
+        if bandHeight and len(scales) > 1:
+            raise ValueError('banded drawing supports only 1x scale')
 
         self.name = name
         self.mode = mode
@@ -45,7 +126,21 @@ class SpriteSheet:
             self.matteColor = (255, 255, 255, 0)
         self.drawBackgrounds = drawBackgrounds
         self.layout = layout
+        self.useManifest = useManifest
+        self.bandHeight = bandHeight
+        self.colors = colors
+        self.dither = dither
+        self.minQuality = minQuality
+        self.formats = tuple(formats)
+        self.webpLossless = webpLossless
+        self.webpQuality = webpQuality
+        self.scales = tuple(scales)
         self.path = ''
+        self.digests = {}
+        self.optimizerResult = None
+        self.outputMode = None
+        self.stats = None
+        self.parts = []
     
     @property
     def transformedImages(self):
@@ -53,66 +148,319 @@ class SpriteSheet:
         returns all images which are included in generated SpriteSheet
         with transformed properties
         '''
+        if self.parts:
+            for part in self.parts:
+                for item in part.transformedImages:
+                    yield item
+            return
         for image, rect in self.layout.placedImages:
             image = copy(image)
             image.filename = self.getFilename()
+            image.sheetSize = self.layout.size
+            image.alternatives = [(self.getFilename(format, scale), _mimeTypes[format], scale)
+                                  for scale in self.scales for format in self.formats]
+            #digests are computed only when CSS uses them
+            image.getDigest = self.getDigest
             yield image, rect.topleft
 
-    def getFilename(self):
-        return self.name + '.png'
+    def getDigest(self, filename):
+        'returns short hash of generated file content'
+        if filename not in self.digests:
+            path = os.path.join(os.path.dirname(self.path), filename)
+            self.digests[filename] = fileHash(path)[:10]
+        return self.digests[filename]
 
-    def write(self, path = ''):
+    def setOutputPath(self, path):
+        'sets folder where spritesheet (and its parts) are written'
         path = path or sheetimage._imageFolder
         self.path = os.path.join(path, self.getFilename())
-        self._placeImages()
-        self._write()
-        self._printInfo()
+        self.digests = {}
+        for part in self.parts:
+            part.setOutputPath(path)
+
+    def getFilename(self, format='png', scale=1):
+        if scale != 1:
+            return '%s@%dx.%s' % (self.name, scale, format)
+        return self.name + '.' + format
+
+    def _getPath(self, format='png', scale=1):
+        return os.path.join(os.path.dirname(self.path), self.getFilename(format, scale))
+
+    def _getOtherPaths(self):
+        'returns paths of images written in other formats or scales than 1x png'
+        return [self._getPath(format, scale) for scale in self.scales for format in self.formats
+                if (format, scale) != ('png', 1)]
+
+    def write(self, path = ''):
+        '''
+        generates spritesheet image into path
+        returns BuildStats
+        '''
+        self._partition()
+        self.setOutputPath(path)
+        if self.parts:
+            partStats = [part.write(path) for part in self.parts]
+            self.stats = BuildStats.combine(self.getFilename(), partStats)
+            return self.stats
+        self.stats = stats = BuildStats(self.getFilename())
+        storeManifest = self.useManifest or self.layout.incremental
+        with stats.timer('load'):
+            self._loadImages()
+            if storeManifest:
+                signature = self.getSignature()
+        placement = None
+        if self.useManifest:
+            placement = isUpToDate(self.path, signature, self._getOtherPaths())
+        if placement is not None:
+            self.layout.setPlacement(placement)
+            stats.upToDate = True
+        else:
+            if self.layout.incremental:
+                manifest = loadManifest(self.path)
+                if manifest:
+                    self.layout.seedPlacement(manifest['placement'])
+            with stats.timer('pack'):
+                self._placeImages()
+            self._write()
+            if storeManifest:
+                saveManifest(self.path, signature, self.layout.getPlacement())
+        self._collectStats()
+        for hook in _buildHooks:
+            hook(self, stats)
+        return stats
+
+    def _partition(self):
+        '''
+        splits spritesheet into parts when layout needs more images
+        parts are named name-0, name-1, ...
+        '''
+        self._setParts(self.layout.partition())
+
+    def _setParts(self, layouts):
+        if len(layouts) == 1 and layouts[0] is self.layout:
+            self.parts = []
+        elif len(layouts) == 1:
+            self.parts = [self._createPart(self.name, layouts[0])]
+        else:
+            self.parts = [self._createPart('%s-%d' % (self.name, i), layout) for i, layout in enumerate(layouts)]
+
+    def _createPart(self, name, layout):
+        part = copy(self)
+        part.name = name
+        part.layout = layout
+        part.parts = []
+        return part
+
+    def getPlacement(self):
+        'returns placement of images computed by write'
+        if self.parts:
+            index = {}
+            for i, im in enumerate(self.layout.images):
+                index.setdefault(id(im), i)
+            return {
+                'parts': [part.getPlacement() for part in self.parts],
+                #indexes of images in parts, parts are restored without partitioning again
+                'members': [[index[id(im)] for im in part.layout.images] for part in self.parts],
+            }
+        return self.layout.getPlacement()
+
+    def setPlacement(self, placement):
+        'restores placement computed by write e.g. in other process'
+        if 'parts' in placement:
+            images = self.layout.images
+            self._setParts([self.layout.createPart([images[i] for i in members])
+                            for members in placement['members']])
+            for part, partPlacement in zip(self.parts, placement['parts']):
+                part.setPlacement(partPlacement)
+        else:
+            self.layout.setPlacement(placement)
+
+    def getSignature(self):
+        'returns all inputs and parameters which affect generated image'
+        return {
+            'images': [im.getSignature() for im in self.layout.images],
+            'layout': self.layout.getParameters(),
+            'mode': self.mode,
+            'colors': self.colors,
+            'dither': self.dither,
+            'minQuality': self.minQuality,
+            'formats': list(self.formats),
+            'webpLossless': self.webpLossless,
+            'webpQuality': self.webpQuality,
+            'scales': list(self.scales),
+            'scaledSources': [[im.getScaledSignature(scale) for im in self.layout.images]
+                              for scale in self.scales if scale != 1],
+            'matteColor': self.matteColor,
+            'drawBackgrounds': self.drawBackgrounds,
+            'pngOptimizer': _pngOptimizer and _pngOptimizer.cmd,
+        }
+
+    def _loadImages(self):
+        '''
+        hashes image files, pixels are decoded later only when
+        spritesheet is not up to date
+        '''
+        if _prefetchThreads > 1:
+            hashImages(self.layout.images, _prefetchThreads)
+            return
+        for im in self.layout.images:
+            im.fileKey()
+
+    def _collectStats(self):
+        stats = self.stats
+        stats.imagesCount = self.layout.imagesCount
+        stats.uniqueImagesCount = len(self.layout.uniqueImages)
+        stats.size = self.layout.size
+        stats.fillCoef = self.layout.fillCoef
+        stats.optimizerResult = self.optimizerResult
+        stats.outputBytes = os.path.getsize(self.path)
+        stats.formatBytes = dict((os.path.basename(path), os.path.getsize(path)) for path in self._getOtherPaths())
+        stats.mode = self.outputMode
+        paths = set(im.path for im in self.layout.uniqueImages)
+        if '' not in paths:
+            stats.inputBytes = sum(os.path.getsize(path) for path in paths)
 
     def _write(self):
-        sheet = PIL.Image.new(self.mode, self.layout.size, self.matteColor)
+        if self.bandHeight:
+            self._writeBanded()
+            return
+        scales = [scale for scale in self.scales if scale != 1]
+        if scales:
+            #resolution variants are rendered concurrently with 1x spritesheet,
+            #PIL releases GIL while resampling and encoding
+            pool = ThreadPool(len(scales))
+            variants = pool.map_async(self._writeScaled, scales)
+            pool.close()
+        with self.stats.timer('draw'):
+            sheet = PIL.Image.new(self._getDrawingMode(), self.layout.size, self.matteColor)
         self._drawImagesInto(sheet)
+        with self.stats.timer('encode'):
+            self._saveOtherFormats(sheet)
+            sheet = self._convertForOutput(sheet)
         self._saveFile(sheet)
+        if scales:
+            with self.stats.timer('scale'):
+                variants.get()
+                pool.join()
+
+    def _writeScaled(self, scale):
+        'renders resolution variant using placement of 1x spritesheet'
+        width, height = self.layout.size
+        sheet = PIL.Image.new(self._getDrawingMode(), (width * scale, height * scale), self.matteColor)
+        for im, rect in self.layout.placedUniqueImages:
+            self._drawImage(sheet, im, rect, scale)
+            im.release()
+        self._saveOtherFormats(sheet, scale)
+        sheet = self._convertForOutput(sheet)
+        path = self._getPath('png', scale)
+        if _pngOptimizer:
+            data = BytesIO()
+            sheet.save(data, 'PNG')
+            _pngOptimizer.optimize(data.getvalue(), path)
+        else:
+            sheet.save(path, optimize=True)
+
+    def _saveOtherFormats(self, sheet, scale=1):
+        for format in self.formats:
+            if format == 'webp':
+                sheet.save(self._getPath(format, scale), 'WEBP', lossless=self.webpLossless,
+                           quality=self.webpQuality, method=6)
+
+    def _getDrawingMode(self):
+        if self.mode in ('P', 'auto'):
+            return 'RGBA'
+        return self.mode
+
+    def _convertForOutput(self, sheet):
+        'converts drawn spritesheet into output mode'
+        if self.mode == 'auto':
+            return reduceLossless(sheet)
+        if self.mode != 'P':
+            return sheet
+        converted = quantize(sheet, self.colors, self.dither)
+        if self.minQuality is not None and psnr(sheet, converted) < self.minQuality:
+            return sheet
+        return converted
+
+    def _writeBanded(self):
+        '''
+        draws spritesheet band by band, each band contains
+        only images which intersect it and is encoded immediately
+        '''
+        width, height = self.layout.size
+        placed = sorted(self.layout.placedUniqueImages, key=lambda item: item[1].top)
+        if _pngOptimizer:
+            fout = BytesIO()
+        else:
+            fout = open(self.path, 'wb')
+        try:
+            writer = PngWriter(fout, self.layout.size, self.mode)
+            active = []
+            nextImage = 0
+            for top in xrange(0, height, self.bandHeight):
+                bottom = min(top + self.bandHeight, height)
+                while nextImage < len(placed) and placed[nextImage][1].top < bottom:
+                    active.append(placed[nextImage])
+                    nextImage += 1
+                with self.stats.timer('draw'):
+                    band = PIL.Image.new(self.mode, (width, bottom - top), self.matteColor)
+                    for im, rect in active:
+                        bandRect = Rect()
+                        bandRect.topleft = rect.left, rect.top - top
+                        bandRect.size = rect.size
+                        self._drawImage(band, im, bandRect)
+                with self.stats.timer('encode'):
+                    writer.writeRows(band.tobytes())
+                for im, rect in active:
+                    if rect.bottom <= bottom:
+                        im.release()
+                active = [(im, rect) for im, rect in active if rect.bottom > bottom]
+            with self.stats.timer('encode'):
+                writer.close()
+            self.outputMode = self.mode
+            if _pngOptimizer:
+                with self.stats.timer('optimize'):
+                    self.optimizerResult = _pngOptimizer.optimize(fout.getvalue(), self.path)
+        finally:
+            fout.close()
 
     def _placeImages(self):
         self.layout.placeImages()
 
     def _drawImagesInto(self, sheet):
-        for im, rect in self.layout.placedImages:
+        '''
+        draws images in placement order, waiting for images decoded
+        in the thread pool is measured as load phase
+        '''
+        #stats are not collected when called outside of write
+        stats = self.stats or BuildStats(self.getFilename())
+        placed = self.layout.placedUniqueImages
+        if _prefetchThreads:
             if not self.drawBackgrounds:
-                im.background = None
-            draw(sheet, im, rect)
+                for im, rect in self.layout.placedUniqueImages:
+                    im.background = None
+            placed = prefetchImages(placed, _prefetchThreads, _prefetchBytes, stats)
+        for im, rect in placed:
+            with stats.timer('draw'):
+                self._drawImage(sheet, im, rect)
+            im.release()
+
+    def _drawImage(self, sheet, im, rect, scale=1):
+        if not self.drawBackgrounds:
+            im.background = None
+        draw(sheet, im, rect, scale)
         
     def _saveFile(self, sheet):
+        self.outputMode = sheet.mode
         if _pngOptimizer:
             self._writeOptimizedImage(sheet, self.path)
         else:
-            sheet.save(self.path, optimize=True)
+            with self.stats.timer('encode'):
+                sheet.save(self.path, optimize=True)
 
     def _writeOptimizedImage(self, sheet, path):
-        tmpfile = tempfile.NamedTemporaryFile(suffix='png').name
-        sheet.save(tmpfile, 'PNG')
-        os.system(_pngOptimizer % (tmpfile, path))
-        os.remove(tmpfile)
-        
-    def _printInfo(self):
-        self._printBaseInfo()
-        self._printSizeInfo()
-
-    def _printBaseInfo(self):
-        nImages = self.layout.imagesCount
-        print 'generating %s containing %d images' % (self.getFilename(), nImages)
-        print '  dimension %d x %dpx' % self.layout.size
-        print '  requests saved %d' % (nImages - 1)
-        print '  filling coeficient is %.2f%%' % (self.layout.fillCoef * 100.0)
-    
-    def _printSizeInfo(self):
-        placedImages = list(self.layout.placedImages)
-        newsize = os.path.getsize(self.path)
-        if all(image.path != '' for image, rect in placedImages):
-            origsize = sum(os.path.getsize(image.path) for image, rect in placedImages)
-            sizeCoef = float(newsize) / origsize * 100.0
-            print '  original images filesize: %s' % prettySize(origsize)
-            print '  spritesheet filesize: %s (%.2f%%)' % (prettySize(newsize), sizeCoef)
-        else:
-            print '  spritesheet filesize: %s' % prettySize(newsize)
-
+        with self.stats.timer('encode'):
+            data = BytesIO()
+            sheet.save(data, 'PNG')
+        with self.stats.timer('optimize'):
+            self.optimizerResult = _pngOptimizer.optimize(data.getvalue(), path)
@@ -0,0 +1,124 @@
+'''
+statistics collected while spritesheets are generated
+'''
+
+import time
+from contextlib import contextmanager
+
+from utils import prettySize
+
+class BuildStats:
+    '''
+    statistics of one generated spritesheet
+
+    attributes:
+        filename - filename of generated image
+        imagesCount - number of images including duplicates
+        uniqueImagesCount - number of images drawn into spritesheet
+        size - dimension of spritesheet
+        mode - PIL mode of written image
+        fillCoef - covered area / spritesheet area ratio
+        inputBytes - summary size of input files, None when some images
+                     were not loaded from file
+        outputBytes - size of generated file
+        formatBytes - sizes of files generated in other formats by filename
+        timings - wall time in seconds spent in phases
+                  'load', 'pack', 'draw', 'encode', 'optimize' and 'scale'
+                  ('scale' is time spent waiting for resolution variants)
+        optimizerResult - OptimizerResult of PNG optimizer or None
+        upToDate - True when generating was skipped thanks to manifest
+        parts - stats of parts for spritesheets split into more images
+    '''
+    phases = ('load', 'pack', 'draw', 'encode', 'optimize', 'scale')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.imagesCount = 0
+        self.uniqueImagesCount = 0
+        self.size = 0, 0
+        self.mode = None
+        self.fillCoef = 0.0
+        self.inputBytes = None
+        self.outputBytes = 0
+        self.formatBytes = {}
+        self.timings = dict.fromkeys(self.phases, 0.0)
+        self.optimizerResult = None
+        self.upToDate = False
+        self.parts = []
+
+    @contextmanager
+    def timer(self, phase):
+        'measures the wall time of with block, times of repeated blocks are summed'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.time() - start
+
+    @property
+    def totalTime(self):
+        return sum(self.timings.values())
+
+    @classmethod
+    def combine(cls, filename, parts):
+        'returns summary stats of spritesheet split into parts'
+        stats = cls(filename)
+        stats.parts = list(parts)
+        for part in parts:
+            stats.imagesCount += part.imagesCount
+            stats.uniqueImagesCount += part.uniqueImagesCount
+            stats.outputBytes += part.outputBytes
+            stats.formatBytes.update(part.formatBytes)
+            for phase, seconds in part.timings.items():
+                stats.timings[phase] += seconds
+        inputs = [part.inputBytes for part in parts]
+        if None not in inputs:
+            stats.inputBytes = sum(inputs)
+        stats.upToDate = all(part.upToDate for part in parts)
+        return stats
+
+    def asDict(self):
+        'returns stats as dict of basic types e.g. for JSON serialization'
+        result = {
+            'filename': self.filename,
+            'imagesCount': self.imagesCount,
+            'uniqueImagesCount': self.uniqueImagesCount,
+            'size': list(self.size),
+            'mode': self.mode,
+            'fillCoef': self.fillCoef,
+            'inputBytes': self.inputBytes,
+            'outputBytes': self.outputBytes,
+            'formatBytes': dict(self.formatBytes),
+            'timings': dict(self.timings),
+            'upToDate': self.upToDate,
+            'parts': [part.asDict() for part in self.parts],
+        }
+        if self.optimizerResult:
+            result['optimizer'] = {
+                'inputBytes': self.optimizerResult.inputBytes,
+                'outputBytes': self.optimizerResult.outputBytes,
+                'seconds': self.optimizerResult.seconds,
+            }
+        return result
+
+def printStats(sheet, stats):
+    'build hook printing human readable stats to stdout'
+    if stats.upToDate:
+        print '%s is up to date' % stats.filename
+        return
+    nImages = stats.imagesCount
+    print 'generating %s containing %d images' % (stats.filename, nImages)
+    print '  dimension %d x %dpx' % stats.size
+    print '  requests saved %d' % (nImages - 1)
+    print '  filling coeficient is %.2f%%' % (stats.fillCoef * 100.0)
+    if stats.inputBytes:
+        sizeCoef = float(stats.outputBytes) / stats.inputBytes * 100.0
+        print '  original images filesize: %s' % prettySize(stats.inputBytes)
+        print '  spritesheet filesize: %s (%.2f%%)' % (prettySize(stats.outputBytes), sizeCoef)
+    else:
+        print '  spritesheet filesize: %s' % prettySize(stats.outputBytes)
+    for filename, size in sorted(stats.formatBytes.items()):
+        print '  %s filesize: %s' % (filename, prettySize(size))
+    if stats.optimizerResult:
+        result = stats.optimizerResult
+        print '  optimizer saved %s in %.2fs' % (prettySize(result.bytesSaved), result.seconds)
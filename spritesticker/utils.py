@@ -2,6 +2,8 @@
 usefull functions of all possible kinds
 '''
 
+import hashlib
+
 def gcd(x, y):
     '''computes greatest common divisor
     >>> gcd(12, 10)
@@ -68,6 +70,17 @@ def findfirst(cond, iterable):
             return item
     return None
 
+def fileHash(path):
+    'returns md5 digest of file content'
+    digest = hashlib.md5()
+    fin = open(path, 'rb')
+    try:
+        for block in iter(lambda: fin.read(65536), ''):
+            digest.update(block)
+    finally:
+        fin.close()
+    return digest.hexdigest()
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -1,15 +1,30 @@
 from datetime import datetime
+from collections import OrderedDict
 
 class CssWriter:
-    def __init__(self):
-        self.selectorToImage = {}
+    def __init__(self, versioning='hash', compact=False):
+        '''
+        versioning - how image urls are changed to force browsers to reload them
+                     'hash' - query contains hash of image content, so unchanged
+                              spritesheets stay cached
+                     'timestamp' - query contains time of CSS generation
+                     None - urls are not changed
+        compact - background image, repeat and color are declared once for all
+                  selectors using the same spritesheet, selectors get only position
+        '''
+        if versioning not in ('hash', 'timestamp', None):
+            raise ValueError('unknown versioning %s' % versioning)
+        self.versioning = versioning
+        self.compact = compact
+        #selectors are written in order of registration
+        self.selectorToImage = OrderedDict()
         self.version = datetime.now().strftime('%Y-%m-%dT%H:%M')
         self.fout = None
 
     def register(self, spriteSheet):
         for image, sheetPos in spriteSheet.transformedImages:
             for p in image.cssProp:
-                self.selectorToImage[p.selector] = image, self._transformPos(p.pos, sheetPos)
+                self.selectorToImage[p.selector] = image, self._transformPos(p.pos, sheetPos, image.trimOffset)
 
     def write(self, filename, pathPrefix=''):
         '''
@@ -19,19 +34,77 @@ class CssWriter:
         self.pathPrefix = pathPrefix
 
         self.fout = file(filename, 'w')
-        for selector, value in self.selectorToImage.items():
-            image, pos = value            
-            self._writeImageCss(selector, image, pos)
+        if self.compact:
+            self._writeCompactCss()
+        else:
+            for selector, value in self.selectorToImage.items():
+                image, pos = value            
+                self._writeImageCss(selector, image, pos)
         self.fout.close()
 
     def _writeImageCss(self, selector, image, pos):
-        imagePath = self.pathPrefix + image.filename + '?' + self.version
+        background = self._getBackground(image)
+        pos = '%dpx %dpx' % pos
+        imageSet = self._getBackgroundSize(image) + self._getImageSet(image)
+        self.fout.write('%(selector)s {background: %(background)s %(pos)s;%(imageSet)s}\n' % locals())
+
+    def _writeCompactCss(self):
+        'writes one rule for each group of selectors sharing the same background'
+        groups = OrderedDict()
+        for selector, (image, pos) in self.selectorToImage.items():
+            declaration = 'background: %s;%s%s' % (self._getBackground(image), self._getBackgroundSize(image),
+                                                     self._getImageSet(image))
+            groups.setdefault(declaration, []).append(selector)
+        for declaration, selectors in groups.items():
+            self.fout.write('%s {%s}\n' % (','.join(selectors), declaration))
+        for selector, (image, pos) in self.selectorToImage.items():
+            self.fout.write('%s {background-position: %dpx %dpx;}\n' % ((selector,) + pos))
+
+    def _getBackground(self, image):
+        'returns background shorthand value without position'
+        imagePath = self._getImagePath(image, image.filename)
         repeat = image.repeat
         color = image.color or ''
-        pos = '%dpx %dpx' % pos
-        self.fout.write('%(selector)s {background: %(color)s url(%(imagePath)s) %(repeat)s %(pos)s;}\n' % locals())
+        return '%(color)s url(%(imagePath)s) %(repeat)s' % locals()
+
+    def _getImagePath(self, image, filename):
+        path = self.pathPrefix + filename
+        if self.versioning == 'hash':
+            return path + '?' + image.getDigest(filename)
+        elif self.versioning == 'timestamp':
+            return path + '?' + self.version
+        return path
+
+    def _getBackgroundSize(self, image):
+        'resolution variants are scaled down to size of 1x spritesheet'
+        if all(scale == 1 for filename, mimeType, scale in image.alternatives):
+            return ''
+        return ' background-size: %dpx %dpx;' % image.sheetSize
+
+    def _getImageSet(self, image):
+        '''
+        returns background-image declaration with image-set of all formats and scales,
+        browsers without image-set support use 1x png from background declaration
+        '''
+        if len(image.alternatives) < 2:
+            return ''
+        withType = len(set(mimeType for filename, mimeType, scale in image.alternatives)) > 1
+        withScale = len(set(scale for filename, mimeType, scale in image.alternatives)) > 1
+        #more efficient formats go first, png is the last fallback
+        alternatives = sorted(image.alternatives, key=lambda item: (item[1] == 'image/png', item[2]))
+        sources = []
+        for filename, mimeType, scale in alternatives:
+            source = 'url(%s)' % self._getImagePath(image, filename)
+            if withType:
+                source += ' type("%s")' % mimeType
+            if withScale:
+                source += ' %dx' % scale
+            sources.append(source)
+        return ' background-image: image-set(%s);' % ', '.join(sources)
 
-    def _transformPos(self, pos, sheetPos):
+    def _transformPos(self, pos, sheetPos, trimOffset=(0, 0)):
+        'trimmed image is placed in sheet without its transparent border'
         sx, sy = sheetPos
         x, y = pos
-        return x - sx, y - sy
+        tx, ty = trimOffset
+        return x - sx + tx, y - sy + ty